@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""Measure how many fly-scan documents per second the RunEngine subscribers sustain.
+
+Loads the profile in the pixi environment (with its in-process Tiled server as
+the catalog) and replays synthetic runs shaped like ``tomo_demo_async``: a
+``tomo_stream`` descriptor with a camera and PandA data keys, one stream
+resource per data key and a ``stream_datum`` per data key for every collect.
+Each run is sent at increasing rates to every subscriber on its own and to the
+RunEngine's whole subscriber chain. For every subscriber and rate it reports the
+achieved throughput (including the time to drain queued documents), the 99th
+percentile of the time a call blocks the caller and the peak memory traced
+while the run was processed. The stream resources point to HDF5 files written
+to a temporary readable storage directory, and a run only counts if Tiled
+stored every document and serves its PandA data back.
+
+    python scripts/benchmark-documents.py --output results.json
+    python scripts/benchmark-documents.py --baseline results.json
+
+With ``--baseline`` the script exits with status 1 if any result is worse than
+the baseline's by more than ``--tolerance``.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+
+RATES = (100, 1_000, 10_000)
+FRAMES_PER_COLLECT = 5
+PANDA_KEYS = ("INENC1_VAL", "PCAP_TS_TRIG")
+
+
+def write_data_files(resources, data_keys, frames):
+    """Create the HDF5 files ``resources`` point to, with room for ``frames`` frames.
+
+    The datasets are chunked and never written to, so they take no space on disk
+    and read back as zeros.
+    """
+    import h5py
+
+    for resource in resources.values():
+        data_key = data_keys[resource["data_key"]]
+        shape = (frames, *data_key["shape"][1:])
+        with h5py.File(urllib.parse.urlsplit(resource["uri"]).path, "a") as f:
+            f.create_dataset(
+                resource["parameters"]["dataset"],
+                shape=shape,
+                maxshape=(None, *shape[1:]),
+                dtype=data_key["dtype_numpy"],
+                chunks=tuple(resource["parameters"]["chunk_shape"]),
+            )
+
+
+def synthetic_run(collects, frames_per_collect, storage):
+    """The documents of a tomography fly scan, in RunEngine order.
+
+    Writes the files of its stream resources to the ``storage`` directory.
+    """
+    start = {
+        "uid": str(uuid.uuid4()),
+        "time": time.time(),
+        "scan_id": 1,
+        "plan_name": "tomo_demo_async",
+    }
+    data_keys = {
+        "manta1": {
+            "source": "synthetic",
+            "shape": [1, 1216, 1936],
+            "dtype": "array",
+            "dtype_numpy": "|u1",
+            "external": "STREAM:",
+            "object_name": "manta1",
+        },
+        **{
+            key: {
+                "source": "synthetic",
+                "shape": [],
+                "dtype": "number",
+                "dtype_numpy": "<f8",
+                "external": "STREAM:",
+                "object_name": "panda1",
+            }
+            for key in PANDA_KEYS
+        },
+    }
+    descriptor = {
+        "uid": str(uuid.uuid4()),
+        "run_start": start["uid"],
+        "time": time.time(),
+        "name": "tomo_stream",
+        "data_keys": data_keys,
+        "configuration": {},
+        "hints": {},
+        "object_keys": {"manta1": ["manta1"], "panda1": list(PANDA_KEYS)},
+    }
+    yield "start", start
+    yield "descriptor", descriptor
+
+    resources = {}
+    for key in data_keys:
+        device = data_keys[key]["object_name"]
+        resources[key] = {
+            "uid": str(uuid.uuid4()),
+            "run_start": start["uid"],
+            "data_key": key,
+            "mimetype": "application/x-hdf5",
+            "uri": f"file://localhost{storage}/{start['uid']}-{device}.h5",
+            "parameters": {
+                "dataset": "/entry/data/data" if device == "manta1" else f"/{key}",
+                "chunk_shape": [1, 1216, 1936] if device == "manta1" else [1024],
+            },
+        }
+    write_data_files(resources, data_keys, collects * frames_per_collect)
+    for resource in resources.values():
+        yield "stream_resource", resource
+
+    for i in range(collects):
+        indices = {
+            "start": i * frames_per_collect,
+            "stop": (i + 1) * frames_per_collect,
+        }
+        for key, resource in resources.items():
+            yield "stream_datum", {
+                "uid": f"{resource['uid']}/{i}",
+                "stream_resource": resource["uid"],
+                "descriptor": descriptor["uid"],
+                "indices": indices,
+                "seq_nums": {
+                    "start": indices["start"] + 1,
+                    "stop": indices["stop"] + 1,
+                },
+            }
+    yield "stop", {
+        "uid": str(uuid.uuid4()),
+        "run_start": start["uid"],
+        "time": time.time(),
+        "exit_status": "success",
+        "num_events": {"tomo_stream": collects * frames_per_collect},
+    }
+
+
+def replay(callback, flush, documents, rate):
+    """Send ``documents`` to ``callback`` at ``rate`` per second and time it."""
+    latencies = []
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    for i, (name, doc) in enumerate(documents):
+        # Pace by schedule rather than sleeping per document, so the callback's
+        # own time counts against the budget.
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        before = time.perf_counter()
+        callback(name, doc)
+        latencies.append(time.perf_counter() - before)
+    flush()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "documents": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "latency_p99": latencies[int(0.99 * (len(latencies) - 1))],
+        "latency_max": latencies[-1],
+        "peak_memory": tracemalloc.get_traced_memory()[1],
+    }
+
+
+def check_catalog(ns, documents):
+    """Raise unless Tiled stored every document of the run and serves its data."""
+    failed = ns["tiled_writer_stage"].metrics()["failed"]
+    if failed:
+        raise RuntimeError(f"{failed} documents could not be written to Tiled")
+    start, stop = documents[0][1], documents[-1][1]
+    frames = ns["tiled_client"][start["uid"]]["tomo_stream"][PANDA_KEYS[0]].read()
+    if len(frames) != stop["num_events"]["tomo_stream"]:
+        raise RuntimeError(
+            f"Tiled serves {len(frames)} of the run's "
+            f"{stop['num_events']['tomo_stream']} frames"
+        )
+
+
+def inner(args):
+    """Run the benchmark inside the profile's environment."""
+    from bluesky_queueserver import set_re_worker_active
+    from bluesky_queueserver.manager.profile_ops import load_worker_startup_code
+    from event_model import DocumentNames
+
+    set_re_worker_active()
+    ns = load_worker_startup_code(startup_dir=str(PROFILE_DIR / "startup"))
+    dispatcher = ns["RE"].dispatcher
+    subscribers = {
+        "document_printer": (ns["document_printer"], ns["document_printer"].flush),
+        "tiled_writer_stage": (
+            ns["tiled_writer_stage"],
+            ns["tiled_writer_stage"].flush,
+        ),
+        "RE": (
+            lambda name, doc: dispatcher.process(DocumentNames[name], doc),
+            lambda: [ns["document_printer"].flush(), ns["tiled_writer_stage"].flush()],
+        ),
+    }
+    storage = ns["TILED_READABLE_STORAGE"].rstrip("/")
+
+    results = {}
+    tracemalloc.start()
+    # The printer writes to stdout; keep it out of the results.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name in args.subscriber or subscribers:
+            callback, flush = subscribers[name]
+            for rate in args.rate or RATES:
+                # One stream_datum per data key and collect, for about
+                # ``duration`` seconds at this rate.
+                collects = max(int(rate * args.duration) // (1 + len(PANDA_KEYS)), 1)
+                documents = list(synthetic_run(collects, FRAMES_PER_COLLECT, storage))
+                results.setdefault(name, {})[str(rate)] = replay(
+                    callback, flush, documents, rate
+                )
+                if name != "document_printer":
+                    check_catalog(ns, documents)
+    tracemalloc.stop()
+    with open(args.inner, "w") as f:
+        json.dump(results, f)
+
+
+def compare(results, baseline, tolerance):
+    """Descriptions of the results worse than the baseline's beyond ``tolerance``."""
+    regressions = []
+    for name, rates in baseline.items():
+        for rate, before in rates.items():
+            after = results.get(name, {}).get(rate)
+            if after is None:
+                continue
+            if after["throughput"] < before["throughput"] * (1 - tolerance):
+                regressions.append(
+                    f"{name} @ {rate}/s: throughput {after['throughput']:.0f}/s, "
+                    f"was {before['throughput']:.0f}/s"
+                )
+            for key in ("latency_p99", "peak_memory"):
+                if after[key] > before[key] * (1 + tolerance):
+                    regressions.append(
+                        f"{name} @ {rate}/s: {key} {after[key]:.6g}, "
+                        f"was {before[key]:.6g}"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--env", default="qs", help="pixi environment")
+    parser.add_argument(
+        "--rate", action="append", type=int, help="documents per second"
+    )
+    parser.add_argument("--subscriber", action="append", help="subscriber to run")
+    parser.add_argument(
+        "--duration", type=float, default=5, help="seconds per run at each rate"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--inner", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.inner:
+        return inner(args)
+
+    samples = []
+    for i in range(args.repeat):
+        with (
+            tempfile.NamedTemporaryFile(suffix=".json") as out,
+            tempfile.TemporaryDirectory() as storage,
+        ):
+            command = [
+                "pixi",
+                "run",
+                "--manifest-path",
+                str(PROFILE_DIR),
+                "-e",
+                args.env,
+                "python",
+                __file__,
+                "--inner",
+                out.name,
+                "--duration",
+                str(args.duration),
+            ]
+            for rate in args.rate or ():
+                command += ["--rate", str(rate)]
+            for name in args.subscriber or ():
+                command += ["--subscriber", name]
+            subprocess.run(
+                command,
+                check=True,
+                cwd=PROFILE_DIR,
+                env={
+                    **os.environ,
+                    "TST_TILED_MODE": "in-process",
+                    "TST_TILED_READABLE_STORAGE": storage,
+                },
+            )
+            samples.append(json.load(open(out.name)))
+        print(f"#{i} done", file=sys.stderr)
+
+    # Median of every metric over the repeats.
+    results = {
+        name: {
+            rate: {
+                key: statistics.median(sample[name][rate][key] for sample in samples)
+                for key in metrics
+            }
+            for rate, metrics in rates.items()
+        }
+        for name, rates in samples[0].items()
+    }
+
+    for name, rates in results.items():
+        print(f"\n{name}")
+        for rate, result in rates.items():
+            print(
+                f"  {rate:>7}/s: {result['throughput']:9.0f} docs/s, "
+                f"p99 {result['latency_p99'] * 1e6:8.1f} us, "
+                f"peak {result['peak_memory'] / 2**20:7.1f} MiB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Measure fly-scan overhead against the simulated PandA, cameras and motor.
+
+Loads the profile in a fresh process with ``TST_SIMULATE=YES``, so the devices
+are mocked and driven by the hardware simulation (see startup/19-simulation.py),
+and runs each scan ``--repeat`` times. For every scan it reports the wall time,
+the overhead on top of the time the motor spends at constant velocity, the
+number of frames written and the per-device timings recorded by the plan timer.
+
+    python scripts/benchmark-flyscan.py --scan tomo --scan seq --repeat 5
+
+``seq`` runs xas_seq_fly_async over 200 unevenly spaced points. xas_demo_async is
+not benchmarked: it has not been ported to ophyd-async.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+
+# Runs inside the pixi environment; prints one JSON line per scan.
+RUNNER = """
+import json, sys, time
+import numpy as np
+from bluesky_queueserver import set_re_worker_active
+from bluesky_queueserver.manager.profile_ops import load_worker_startup_code
+
+set_re_worker_active()
+ns = load_worker_startup_code(startup_dir=sys.argv[1])
+scans = json.loads(sys.argv[2])
+repeat = int(sys.argv[3])
+
+for scan, kwargs in scans.items():
+    for _ in range(repeat):
+        if scan == "tomo":
+            plan = ns["tomo_demo_async"]([ns["manta1"]], ns["panda1"], **kwargs)
+            scan_time = kwargs["scan_time"]
+        elif scan == "tomo-multi":
+            plan = ns["tomo_multi_sweep_async"]([ns["manta1"]], ns["panda1"], **kwargs)
+            scan_time = kwargs["scan_time"] * kwargs["num_sweeps"]
+        else:
+            # Quadratically spaced points, like k-space ones, over half a turn.
+            positions = 180 * np.linspace(0.2, 1, kwargs["num_points"]) ** 2
+            plan = ns["xas_seq_fly_async"](
+                ns["panda1"],
+                positions,
+                kwargs["exposure_time"],
+                kwargs["scan_time"],
+                detectors=[ns["manta1"]],
+            )
+            scan_time = kwargs["scan_time"]
+        start = time.perf_counter()
+        ns["RE"](plan)
+        wall = time.perf_counter() - start
+        timer = ns["plan_timer"]
+        print(json.dumps({
+            "scan": scan,
+            "wall": wall,
+            "scan_time": scan_time,
+            "frames": ns["simulation"].cameras["manta1"].num_captured,
+            "timings": [
+                [command, device, seconds]
+                for (command, device), seconds in timer.summary().items()
+            ],
+        }), flush=True)
+"""
+
+SCANS = {
+    "tomo": {"num_images": 181, "scan_time": 5},
+    "tomo-multi": {"num_sweeps": 4, "num_images": 181, "scan_time": 5},
+    "seq": {"num_points": 200, "exposure_time": 0.003, "scan_time": 5},
+}
+
+
+def run(scans, repeat, env):
+    with tempfile.TemporaryDirectory() as data_dir:
+        result = subprocess.run(
+            [
+                "pixi",
+                "run",
+                "--manifest-path",
+                str(PROFILE_DIR),
+                "-e",
+                env,
+                "python",
+                "-c",
+                RUNNER,
+                str(PROFILE_DIR / "startup"),
+                json.dumps({scan: SCANS[scan] for scan in scans}),
+                str(repeat),
+            ],
+            check=True,
+            cwd=PROFILE_DIR,
+            env={
+                **os.environ,
+                "TST_SIMULATE": "YES",
+                "TST_SIMULATION_DATA_DIR": data_dir,
+            },
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+    return [
+        json.loads(line) for line in result.stdout.splitlines() if line.startswith("{")
+    ]
+
+
+def summarize(samples):
+    overheads = [sample["wall"] - sample["scan_time"] for sample in samples]
+    timings = {}
+    for sample in samples:
+        for command, device, seconds in sample["timings"]:
+            timings.setdefault(f"{command} {device}", []).append(seconds)
+    return {
+        "samples": len(samples),
+        "wall_median": statistics.median(sample["wall"] for sample in samples),
+        "overhead_min": min(overheads),
+        "overhead_median": statistics.median(overheads),
+        "overhead_max": max(overheads),
+        "frames": samples[-1]["frames"],
+        "timings": {
+            name: statistics.median(values)
+            for name, values in sorted(timings.items(), key=lambda item: -max(item[1]))
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scan", action="append", choices=sorted(SCANS), help="scan to run"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--env", default="terminal", help="pixi environment")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    scans = args.scan or sorted(SCANS)
+    samples = run(scans, args.repeat, args.env)
+    results = {
+        scan: summarize([sample for sample in samples if sample["scan"] == scan])
+        for scan in scans
+    }
+
+    for scan, summary in results.items():
+        print(
+            f"\n{scan}: wall median {summary['wall_median']:.2f} s, overhead "
+            f"{summary['overhead_median']:.2f} s (min {summary['overhead_min']:.2f} s, "
+            f"max {summary['overhead_max']:.2f} s), {summary['frames']} frames"
+        )
+        for name, seconds in list(summary["timings"].items())[:10]:
+            print(f"  {seconds:8.3f} s  {name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Measure sustained HDF5 write throughput and file size for each camera setting.
+
+Writes Manta-sized frames the way the areaDetector HDF5 plugin does (one frame
+appended at a time to a chunked, SWMR dataset) with every compression setting
+the IOC offers and a range of frames per chunk, to files in ``--directory``
+(point it at the proposal filesystem to measure the disk the beamline writes
+to). For every setting it reports the rate at which uncompressed frame data was
+absorbed, including the final flush and fsync, and the size of the file.
+
+    python scripts/benchmark-hdf5.py --directory /nsls2/data/tst/... --duration 10
+
+Runs in the pixi environment, where ``blosc-hdf5-plugin`` and
+``hdf5-external-filter-plugins`` provide the filters; settings whose filter is
+not available are skipped.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+
+BLOSC, LZ4, BITSHUFFLE = 32001, 32004, 32008
+BLOSC_LZ4, BLOSC_ZSTD = 1, 5
+SHUFFLE = {"none": 0, "byte": 1, "bit": 2}
+
+
+def settings(itemsize):
+    """``(name, filter, options)`` for each setting, matching the IOC's choices."""
+    # Shuffling the bytes of a single byte type does nothing.
+    shuffle = "bit" if itemsize == 1 else "byte"
+    s = SHUFFLE[shuffle]
+    return [
+        ("none", None, None),
+        ("zlib-1", "gzip", 1),
+        (f"blosc-lz4-1-{shuffle}", BLOSC, (0, 0, 0, 0, 1, s, BLOSC_LZ4)),
+        (f"blosc-lz4-5-{shuffle}", BLOSC, (0, 0, 0, 0, 5, s, BLOSC_LZ4)),
+        (f"blosc-zstd-3-{shuffle}", BLOSC, (0, 0, 0, 0, 3, s, BLOSC_ZSTD)),
+        ("bslz4", BITSHUFFLE, (0, 2)),
+        ("lz4", LZ4, (0,)),
+    ]
+
+
+def synthetic_frames(shape, dtype, count=16):
+    """Noisy frames over a smooth background, compressible like camera images."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[: shape[0], : shape[1]]
+    background = np.exp(
+        -(((y - shape[0] / 2) / shape[0]) ** 2 + ((x - shape[1] / 2) / shape[1]) ** 2)
+        * 4
+    )
+    top = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+    return [
+        np.clip(
+            rng.poisson(background * top / 4) + rng.normal(0, 2, shape), 0, top
+        ).astype(dtype)
+        for _ in range(count)
+    ]
+
+
+def load_frames(path, count=16):
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        data = f["entry/data/data"]
+        return [data[i] for i in range(min(count, len(data)))]
+
+
+def write(path, frames, compression, options, frames_per_chunk, duration):
+    """Append ``frames`` in turn for ``duration`` seconds; return the frames written."""
+    import h5py
+
+    shape, dtype = frames[0].shape, frames[0].dtype
+    start = time.perf_counter()
+    # Like the plugin, keep a whole chunk in the cache until it is complete, so
+    # each chunk is compressed and written once.
+    cache = 2 * frames_per_chunk * frames[0].nbytes
+    with h5py.File(path, "w", libver="latest", rdcc_nbytes=cache) as f:
+        data = f.create_dataset(
+            "entry/data/data",
+            (0, *shape),
+            maxshape=(None, *shape),
+            chunks=(frames_per_chunk, *shape),
+            dtype=dtype,
+            compression=compression,
+            compression_opts=options,
+        )
+        f.swmr_mode = True
+        written = 0
+        while time.perf_counter() - start < duration or written % frames_per_chunk:
+            data.resize(written + 1, axis=0)
+            data[written] = frames[written % len(frames)]
+            written += 1
+        f.flush()
+        os.fsync(f.id.get_vfd_handle())
+    return written, time.perf_counter() - start
+
+
+def inner(args):
+    """Run the benchmark inside the profile's environment."""
+    import h5py
+    import numpy as np
+
+    if args.frames:
+        frames = load_frames(args.frames)
+    else:
+        frames = synthetic_frames(tuple(args.shape), np.dtype(args.dtype))
+    frame_bytes = frames[0].nbytes
+
+    results = {}
+    directory = Path(args.directory or tempfile.gettempdir())
+    for name, compression, options in settings(frames[0].dtype.itemsize):
+        if isinstance(compression, int) and not h5py.h5z.filter_avail(compression):
+            print(f"{name}: filter {compression} not available", file=sys.stderr)
+            continue
+        for frames_per_chunk in args.frames_per_chunk or (1, 4, 16):
+            path = directory / f"benchmark-hdf5-{os.getpid()}-{name}.h5"
+            try:
+                written, elapsed = write(
+                    path, frames, compression, options, frames_per_chunk, args.duration
+                )
+                size = path.stat().st_size
+            finally:
+                path.unlink(missing_ok=True)
+            results[f"{name}/{frames_per_chunk}"] = {
+                "frames": written,
+                "frames_per_second": written / elapsed,
+                "throughput": written * frame_bytes / elapsed,
+                "disk_throughput": size / elapsed,
+                "file_size": size,
+                "ratio": written * frame_bytes / size,
+            }
+    with open(args.inner, "w") as f:
+        json.dump(results, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--env", default="terminal", help="pixi environment")
+    parser.add_argument("--directory", help="where to write (default: the temp dir)")
+    parser.add_argument(
+        "--frames", help="HDF5 file of real frames at /entry/data/data to write"
+    )
+    parser.add_argument(
+        "--shape", type=int, nargs=2, default=(1216, 1936), help="synthetic frames"
+    )
+    parser.add_argument("--dtype", default="uint8", help="synthetic frames")
+    parser.add_argument("--frames-per-chunk", action="append", type=int)
+    parser.add_argument(
+        "--duration", type=float, default=5, help="seconds to write each setting"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--inner", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.inner:
+        return inner(args)
+
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        command = [
+            "pixi",
+            "run",
+            "--manifest-path",
+            str(PROFILE_DIR),
+            "-e",
+            args.env,
+            "python",
+            __file__,
+            "--inner",
+            out.name,
+            "--shape",
+            *map(str, args.shape),
+            "--dtype",
+            args.dtype,
+            "--duration",
+            str(args.duration),
+        ]
+        for option in ("directory", "frames"):
+            if getattr(args, option):
+                command += [f"--{option}", str(Path(getattr(args, option)).resolve())]
+        for frames_per_chunk in args.frames_per_chunk or ():
+            command += ["--frames-per-chunk", str(frames_per_chunk)]
+        subprocess.run(command, check=True, cwd=PROFILE_DIR)
+        results = json.load(open(out.name))
+
+    for name, result in sorted(
+        results.items(), key=lambda item: -item[1]["throughput"]
+    ):
+        print(
+            f"{name:>24}: {result['throughput'] / 1e6:8.1f} MB/s "
+            f"({result['frames_per_second']:7.1f} frames/s), "
+            f"disk {result['disk_throughput'] / 1e6:8.1f} MB/s, "
+            f"ratio {result['ratio']:5.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
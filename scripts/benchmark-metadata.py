@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Measure RE.md read latency and cache invalidation against a local Redis server.
+
+Starts a throwaway ``redis-server`` (from ``PATH`` or ``--redis-server``) on a
+free port, optionally with keyspace notifications enabled, and loads the profile
+in the pixi environment with ``TST_REDIS_URL`` pointing at it, so ``RE.md`` is the
+cached Redis dictionary of 00-startup.py. It reports the time to read a key, to
+copy the whole dictionary as ``open_run`` does and to resolve a detector path,
+next to the same reads through a plain ``RedisJSONDict``, and how long a change
+made by another client takes to reach ``RE.md``.
+
+    python scripts/benchmark-metadata.py
+    python scripts/benchmark-metadata.py --keyspace-notifications
+
+Exits with status 1 if a change by another client is not seen within
+``--timeout`` seconds.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+
+METADATA = {
+    "cycle": "2026-3",
+    "data_session": "pass-000000",
+    "proposal": {"proposal_id": "000000", "title": "Benchmark", "users": []},
+    "scan_id": 0,
+}
+
+
+def timed(function, repeat):
+    """Median seconds per call of ``function`` over ``repeat`` calls."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def propagation(md, writer, timeout):
+    """Seconds until a change to ``cycle`` made through ``writer`` shows in ``md``."""
+    value = f"changed-{time.time()}"
+    start = time.perf_counter()
+    writer["cycle"] = value
+    while md["cycle"] != value:
+        if time.perf_counter() - start > timeout:
+            return None
+        time.sleep(0.0005)
+    return time.perf_counter() - start
+
+
+def inner(args):
+    """Run the benchmark inside the profile's environment."""
+    import redis
+    import redis_json_dict
+    from bluesky_queueserver import set_re_worker_active
+    from bluesky_queueserver.manager.profile_ops import load_worker_startup_code
+
+    client = redis.Redis.from_url(os.environ["TST_REDIS_URL"])
+    plain = redis_json_dict.RedisJSONDict(client, prefix="")
+    plain.update(METADATA)
+
+    set_re_worker_active()
+    ns = load_worker_startup_code(
+        startup_dir=str(PROFILE_DIR / "startup"), keep_re=True
+    )
+    md = ns["RE"].md
+
+    results = {"keyspace_notifications": md._keyspace}
+    for name, mapping in (("cached", md), ("plain", plain)):
+        # The provider reads the cycle and data session on every call.
+        provider = ns["TSTPathProvider"](mapping)
+        results[name] = {
+            "read": timed(lambda: mapping["cycle"], args.repeat),
+            "copy": timed(lambda: dict(mapping), args.repeat),
+            "path": timed(lambda: provider("manta1"), args.repeat),
+        }
+
+    other = ns["CachedRedisJSONDict"](os.environ["TST_REDIS_URL"])
+    results["propagation"] = {
+        "cached_writer": propagation(md, other, args.timeout),
+        # Only seen with keyspace notifications.
+        "plain_writer": propagation(md, plain, args.timeout),
+    }
+    other.close()
+    with open(args.inner, "w") as f:
+        json.dump(results, f)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--env", default="qs", help="pixi environment")
+    parser.add_argument("--redis-server", default=shutil.which("redis-server"))
+    parser.add_argument("--keyspace-notifications", action="store_true")
+    parser.add_argument("--repeat", type=int, default=10_000)
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--inner", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.inner:
+        return inner(args)
+
+    if not args.redis_server:
+        parser.error("no redis-server on PATH; install one or pass --redis-server")
+
+    port = free_port()
+    server_args = [args.redis_server, "--port", str(port), "--save", ""]
+    if args.keyspace_notifications:
+        server_args += ["--notify-keyspace-events", "KA"]
+    with tempfile.TemporaryDirectory() as data_dir, tempfile.NamedTemporaryFile(
+        suffix=".json"
+    ) as out:
+        server = subprocess.Popen(server_args, cwd=data_dir, stdout=subprocess.DEVNULL)
+        try:
+            time.sleep(0.5)
+            subprocess.run(
+                [
+                    "pixi",
+                    "run",
+                    "--manifest-path",
+                    str(PROFILE_DIR),
+                    "-e",
+                    args.env,
+                    "python",
+                    __file__,
+                    "--inner",
+                    out.name,
+                    "--repeat",
+                    str(args.repeat),
+                    "--timeout",
+                    str(args.timeout),
+                ],
+                check=True,
+                cwd=PROFILE_DIR,
+                env={**os.environ, "TST_REDIS_URL": f"redis://localhost:{port}/0"},
+            )
+            results = json.load(open(out.name))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"keyspace notifications: {results['keyspace_notifications']}")
+    for name in ("cached", "plain"):
+        print(f"\n{name}")
+        for key, seconds in results[name].items():
+            print(f"  {key:>16}: {seconds * 1e6:10.1f} us")
+    print("\npropagation")
+    for writer, seconds in results["propagation"].items():
+        shown = "not seen" if seconds is None else f"{seconds * 1e3:10.2f} ms"
+        print(f"  {writer:>16}: {shown}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if results["propagation"]["cached_writer"] is None:
+        return 1
+    if args.keyspace_notifications and results["propagation"]["plain_writer"] is None:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Measure how long the profile takes to come up in the pixi environments.
+
+Every sample starts the profile in a fresh process, the way a user's IPython
+session (``terminal`` environment) or the queueserver's RE worker (``qs``
+environment) would, and reads the per-file breakdown from the report the
+startup profiler writes. The first sample of each environment is reported
+separately as the cold start.
+
+    python scripts/benchmark-startup.py --env terminal --env qs --repeat 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+
+# The RE worker marks itself as active before it loads the startup code, so the
+# profile skips the IPython-only setup; do the same here.
+QS_LOADER = """
+import sys
+from bluesky_queueserver import set_re_worker_active
+from bluesky_queueserver.manager.profile_ops import load_worker_startup_code
+
+set_re_worker_active()
+load_worker_startup_code(startup_dir=sys.argv[1])
+"""
+
+COMMANDS = {
+    "terminal": ["ipython", f"--profile-dir={PROFILE_DIR}", "-c", "exit()"],
+    "qs": ["python", "-c", QS_LOADER, str(PROFILE_DIR / "startup")],
+}
+
+
+def run_once(env, report_dir):
+    command = ["pixi", "run", "--manifest-path", str(PROFILE_DIR), "-e", env]
+    command += COMMANDS[env]
+    start = time.perf_counter()
+    subprocess.run(
+        command,
+        check=True,
+        cwd=PROFILE_DIR,
+        env={**os.environ, "TST_STARTUP_PROFILE_DIR": str(report_dir)},
+        stdout=subprocess.DEVNULL,
+    )
+    wall = time.perf_counter() - start
+
+    reports = sorted(Path(report_dir).glob("startup_*.json"))
+    if not reports:
+        return {"wall": wall, "files": {}}
+    with open(reports[-1]) as f:
+        report = json.load(f)
+    files = {
+        section["name"]: {
+            "elapsed": section["elapsed"],
+            "imports": section["imports"],
+            "connect": section["connect"],
+        }
+        for section in report["files"]
+    }
+    return {"wall": wall, "profile": report["total"], "files": files}
+
+
+def summarize(samples):
+    walls = [sample["wall"] for sample in samples]
+    summary = {
+        "cold": walls[0],
+        "samples": len(walls),
+    }
+    warm = walls[1:]
+    if warm:
+        summary.update(
+            warm_min=min(warm),
+            warm_median=statistics.median(warm),
+            warm_max=max(warm),
+        )
+    per_file = {}
+    for sample in samples:
+        for name, timing in sample["files"].items():
+            per_file.setdefault(name, []).append(timing)
+    summary["files"] = {
+        name: {
+            key: statistics.median(timing[key] for timing in timings)
+            for key in ("elapsed", "imports", "connect")
+        }
+        for name, timings in per_file.items()
+    }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--env", action="append", choices=sorted(COMMANDS), help="pixi environment"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for env in args.env or sorted(COMMANDS):
+        samples = []
+        for i in range(args.repeat):
+            with tempfile.TemporaryDirectory() as report_dir:
+                samples.append(run_once(env, report_dir))
+            print(f"{env} #{i}: {samples[-1]['wall']:.2f} s", file=sys.stderr)
+        results[env] = summarize(samples)
+
+    for env, summary in results.items():
+        print(f"\n{env}: cold {summary['cold']:.2f} s", end="")
+        if "warm_median" in summary:
+            print(f", warm median {summary['warm_median']:.2f} s", end="")
+        print()
+        for name, timing in summary["files"].items():
+            print(
+                f"  {name:<24} {timing['elapsed']:7.3f} s "
+                f"(imports {timing['imports']:.3f} s, connect {timing['connect']:.3f} s)"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Regenerate startup/existing_plans_and_devices.yaml only where the profile changed.
+
+The list of plans and devices the RE Manager offers is built by loading the
+profile and introspecting every plan, which takes far longer than reading the
+list. This script keys the result on the content of every startup file and the
+versions of the libraries the plans come from, and does nothing when neither
+changed. Otherwise it loads the profile, reuses the cached description of every
+plan whose source (and the set of plan and device names it can refer to) is
+unchanged, introspects the rest with the queueserver and rewrites the file.
+
+Equal parts of the descriptions (parameter kinds, annotations, whole parameters
+shared by the plan stubs) are written once as YAML anchors and referred to by
+alias, so the file is smaller and the RE Manager parses each of them once; the
+file stays loadable by ``load_existing_plans_and_devices``.
+
+    python scripts/gen-plans-devices.py           # in the qs environment
+    python scripts/gen-plans-devices.py --check   # exit 1 if the file is stale
+"""
+
+import argparse
+import hashlib
+import importlib.metadata
+import inspect
+import json
+import sys
+import time
+from pathlib import Path
+
+PROFILE_DIR = Path(__file__).resolve().parent.parent
+STARTUP_DIR = PROFILE_DIR / "startup"
+OUTPUT = STARTUP_DIR / "existing_plans_and_devices.yaml"
+CACHE = PROFILE_DIR / ".cache" / "plans-and-devices.json"
+
+HEADER = "# This file is automatically generated. Edit at your own risk.\n"
+KEY_PREFIX = "# Profile key: "
+LIBRARIES = (
+    "bluesky",
+    "bluesky-queueserver",
+    "nslsii",
+    "ophyd",
+    "ophyd-async",
+)
+# Parts of the descriptions shorter than this (as JSON) are not worth an alias.
+MIN_SHARED_SIZE = 40
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def profile_key():
+    """Changes whenever a startup file or the version of a library does."""
+    versions = []
+    for library in LIBRARIES:
+        try:
+            versions.append(f"{library}=={importlib.metadata.version(library)}")
+        except importlib.metadata.PackageNotFoundError:
+            versions.append(f"{library} missing")
+    files = sorted(STARTUP_DIR.glob("*.py"))
+    return digest(
+        sys.version,
+        *versions,
+        *(part for path in files for part in (path.name, path.read_bytes())),
+    )
+
+
+def file_key():
+    """The profile key recorded in the generated file, if any."""
+    try:
+        with open(OUTPUT) as f:
+            for line in f:
+                if not line.startswith("#"):
+                    break
+                if line.startswith(KEY_PREFIX):
+                    return line[len(KEY_PREFIX) :].strip()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def plan_key(plan, names):
+    """Changes with the plan's source (decorators included) or the known names."""
+    try:
+        source = inspect.getsource(plan)
+    except (OSError, TypeError):
+        return None
+    return digest(getattr(plan, "__module__", ""), source, names)
+
+
+def share_equal_parts(value, shared=None):
+    """Return ``value`` with equal dicts and lists replaced by a single object.
+
+    ``yaml.dump`` writes an object met more than once as an anchor and aliases.
+    """
+    shared = {} if shared is None else shared
+    if isinstance(value, dict):
+        value = {k: share_equal_parts(v, shared) for k, v in value.items()}
+    elif isinstance(value, list):
+        value = [share_equal_parts(v, shared) for v in value]
+    else:
+        return value
+    key = json.dumps(value, sort_keys=True, default=str)
+    if len(key) < MIN_SHARED_SIZE:
+        return value
+    return shared.setdefault(key, value)
+
+
+def generate(args, key):
+    from bluesky_queueserver import set_re_worker_active
+    from bluesky_queueserver.manager.profile_ops import (
+        _prepare_devices,
+        _process_plan,
+        devices_from_nspace,
+        load_worker_startup_code,
+        plans_from_nspace,
+        reg_ns_items,
+    )
+
+    try:
+        cache = json.loads(CACHE.read_text())
+    except (FileNotFoundError, ValueError):
+        cache = {}
+
+    start = time.perf_counter()
+    set_re_worker_active()
+    nspace = load_worker_startup_code(startup_dir=str(STARTUP_DIR))
+    loaded = time.perf_counter()
+
+    plans = plans_from_nspace(nspace)
+    plans.update({name: item["obj"] for name, item in reg_ns_items.reg_plans.items()})
+    devices = devices_from_nspace(nspace)
+    existing_devices = _prepare_devices(devices, max_depth=args.max_depth)
+    names = digest(*sorted(plans), "|", *sorted(existing_devices))
+
+    cached_plans = cache.get("plans", {})
+    existing_plans, entries, reused = {}, {}, 0
+    for name, plan in sorted(plans.items()):
+        entry = cached_plans.get(name)
+        plan_source_key = plan_key(plan, names)
+        if plan_source_key and entry and entry["key"] == plan_source_key:
+            description = entry["description"]
+            reused += 1
+        else:
+            try:
+                description = _process_plan(
+                    plan, existing_devices=existing_devices, existing_plans=set(plans)
+                )
+            except Exception as ex:
+                if not args.ignore_invalid_plans:
+                    raise
+                print(f"Ignoring plan {name}: {ex}", file=sys.stderr)
+                continue
+        # As the cache stores it, so fresh and reused descriptions are written alike.
+        description = json.loads(json.dumps(description))
+        existing_plans[name] = description
+        if plan_source_key is not None:
+            entries[name] = {"key": plan_source_key, "description": description}
+
+    write(existing_plans, existing_devices, key)
+    CACHE.parent.mkdir(parents=True, exist_ok=True)
+    CACHE.write_text(json.dumps({"plans": entries}))
+    print(
+        f"Wrote {OUTPUT.relative_to(PROFILE_DIR)}: {len(existing_plans)} plans "
+        f"({reused} unchanged), {len(existing_devices)} devices; loading the "
+        f"profile took {loaded - start:.1f} s, the rest "
+        f"{time.perf_counter() - loaded:.1f} s."
+    )
+
+
+def write(existing_plans, existing_devices, key):
+    import yaml
+
+    content = share_equal_parts(
+        {"existing_devices": existing_devices, "existing_plans": existing_plans}
+    )
+    with open(OUTPUT, "w") as f:
+        f.write(HEADER)
+        f.write(f"{KEY_PREFIX}{key}\n")
+        yaml.dump(content, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--check", action="store_true", help="only report whether the file is stale"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="regenerate even if nothing changed"
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=1,
+        help="depth of the subdevices listed (0: all)",
+    )
+    parser.add_argument("--ignore-invalid-plans", action="store_true")
+    args = parser.parse_args()
+
+    key = profile_key()
+    if file_key() == key and not args.force:
+        print(f"{OUTPUT.relative_to(PROFILE_DIR)} is up to date.")
+        return 0
+    if args.check:
+        print(f"{OUTPUT.relative_to(PROFILE_DIR)} is stale.", file=sys.stderr)
+        return 1
+    generate(args, key)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,108 +1,617 @@
 # Make ophyd listen to pyepics.
-print(f"Loading file {__file__!r} ...")
-
 import asyncio
+import atexit
+import builtins
+import collections
+import collections.abc
+import contextlib
+import copy
 import datetime
+import importlib
+import json
 import logging
 import os
+import secrets
 import subprocess
+import sys
+import tempfile
+import threading
 import time as ttime
+import types
+import urllib.parse
+import urllib.request
 import warnings
+from pathlib import Path
+
+
+class _ProfileSection:
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.start = ttime.perf_counter()
+        self.elapsed = None
+        self.import_time = 0.0
+        self.children = []
+        self.details = {}
+
+    def total(self, category):
+        """Time spent in ``category`` in this section and all nested sections.
+
+        Imports count only as ``"import"``, also inside sections of other
+        categories, so the totals of different categories never overlap.
+        """
+        if category == "import":
+            return self.import_time + sum(c.total(category) for c in self.children)
+        if self.category == category:
+            return self.elapsed - self.total("import")
+        return sum(child.total(category) for child in self.children)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "category": self.category,
+            "elapsed": self.elapsed,
+            "import_time": self.import_time,
+            "details": self.details,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def folded(self, prefix=()):
+        """Yield ``(stack, seconds)`` pairs of the self time of this subtree."""
+        stack = (*prefix, self.name)
+        children = sum(child.elapsed for child in self.children)
+        if self.import_time:
+            yield (*stack, "import"), self.import_time
+        yield stack, max(self.elapsed - children - self.import_time, 0.0)
+        for child in self.children:
+            yield from child.folded(stack)
+
+
+class StartupProfiler:
+    """Record where the time goes while the profile's startup files load.
+
+    Every startup file is bracketed by ``start_file``/``stop_file``, and any block
+    inside it can be timed with the ``section`` context manager; sections nest
+    freely, and a file that raised is closed when the next one starts. While the
+    profiler is active, top-level ``import`` statements on the loading thread are
+    timed and charged to the innermost open section, and sections of category
+    ``"connect"`` (see ``DeviceRegistry.connect_all``) count as device-connect
+    time. ``finish`` writes the tree as JSON and as folded stacks (one
+    ``a;b;c <microseconds>`` line per stack) for flamegraph.pl or speedscope.
+
+    ``finish`` is called by the last startup file, ``zz-startup-report.py``; after
+    it, ``start_file`` and ``stop_file`` only print. If loading stops before that
+    file, the import hook is removed and the report written at exit.
+    """
+
+    def __init__(self, report_dir=None):
+        self.report_dir = Path(
+            report_dir
+            or os.environ.get("TST_STARTUP_PROFILE_DIR")
+            or Path(tempfile.gettempdir()) / "tst-profile-startup"
+        )
+        self.sections = []
+        self.finished = False
+        self._stack = []
+        self._thread_id = threading.get_ident()
+        self._import_depth = 0
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+        atexit.register(self.finish)
+
+    def start_file(self, filename):
+        print(f"Loading file {filename!r} ...")
+        if self.finished:
+            return
+        # A file that raised was never stopped; close it and what it left open.
+        while self._stack:
+            unclosed = self._pop()
+            print(f"Section {unclosed.name!r} was not closed.")
+        self._push(Path(filename).name, "file")
+
+    def stop_file(self, filename):
+        name = Path(filename).name
+        if self.finished:
+            print(f"Done loading {name}.")
+            return
+        while self._stack and self._stack[-1].name != name:
+            unclosed = self._pop()
+            print(f"Section {unclosed.name!r} was not closed before {name!r}.")
+        if not self._stack:
+            raise RuntimeError(f"Startup file {name!r} was never started.")
+        section = self._pop()
+        imports = section.total("import")
+        connect = section.total("connect")
+        print(
+            f"Done loading {name} in {section.elapsed:.3f} seconds "
+            f"(imports {imports:.3f}s, device connect {connect:.3f}s, "
+            f"other {section.elapsed - imports - connect:.3f}s)."
+        )
+
+    @contextlib.contextmanager
+    def section(self, name, category="other", **details):
+        section = self._push(name, category)
+        section.details.update(details)
+        try:
+            yield section
+        finally:
+            while self._stack and self._pop() is not section:
+                pass
+
+    def finish(self):
+        """Stop timing imports and write the JSON and folded-stack reports."""
+        if self.finished:
+            return
+        if builtins.__import__ == self._timed_import:
+            builtins.__import__ = self._original_import
+        self.finished = True
+        atexit.unregister(self.finish)
+        while self._stack:
+            self._pop()
+
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = self.report_dir / f"startup_{stamp}_{os.getpid()}"
+        report = {
+            "argv": sys.argv,
+            "pid": os.getpid(),
+            "re_worker": is_re_worker_active(),
+            "total": sum(section.elapsed for section in self.sections),
+            "files": [
+                {
+                    **section.to_dict(),
+                    "imports": section.total("import"),
+                    "connect": section.total("connect"),
+                }
+                for section in self.sections
+            ],
+        }
+        try:
+            self.report_dir.mkdir(parents=True, exist_ok=True)
+            with open(f"{base}.json", "w") as f:
+                json.dump(report, f, indent=2, default=str)
+            with open(f"{base}.folded", "w") as f:
+                for section in self.sections:
+                    for stack, seconds in section.folded():
+                        f.write(f"{';'.join(stack)} {round(seconds * 1e6)}\n")
+        except OSError as ex:
+            print(f"Could not write the startup profile to {self.report_dir}: {ex}")
+            return
+        print(
+            f"Profile loaded in {report['total']:.3f} seconds, "
+            f"startup report written to {base}.json"
+        )
+
+    def _push(self, name, category):
+        section = _ProfileSection(name, category)
+        if self.finished:
+            return section
+        if self._stack:
+            self._stack[-1].children.append(section)
+        else:
+            self.sections.append(section)
+        self._stack.append(section)
+        return section
+
+    def _pop(self):
+        section = self._stack.pop()
+        section.elapsed = ttime.perf_counter() - section.start
+        return section
+
+    def _timed_import(self, *args, **kwargs):
+        if (
+            self._import_depth
+            or self.finished
+            or not self._stack
+            or threading.get_ident() != self._thread_id
+        ):
+            return self._original_import(*args, **kwargs)
+        self._import_depth += 1
+        start = ttime.perf_counter()
+        try:
+            return self._original_import(*args, **kwargs)
+        finally:
+            self._import_depth -= 1
+            self._stack[-1].import_time += ttime.perf_counter() - start
+
+
+startup_profiler = StartupProfiler()
+startup_profiler.start_file(__file__)
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """Return a stand-in for module ``name`` that imports it on first attribute access.
+
+    Use this for subsystems that only some sessions need (e.g. redis in non-DEBUG
+    mode) so that loading the profile does not pay for them up front.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
+
 
 import bluesky.plan_stubs as bps
 import bluesky.plans as bp
 import epicscorelibs.path.pyepics
-import nslsii
-import redis
-from bluesky.callbacks.broker import post_run, verify_files_saved
 from bluesky.callbacks.tiled_writer import TiledWriter
 from bluesky.plans import count, scan
 from bluesky.run_engine import RunEngine, autoawait_in_bluesky_event_loop
 from bluesky_queueserver import is_re_worker_active
-from IPython import get_ipython
-from ophyd.sim import det, motor
-from redis_json_dict import RedisJSONDict
 from tiled.client import from_uri
-from tiled.server import SimpleTiledServer
+
+nslsii = lazy_import("nslsii")
+ophyd_sim = lazy_import("ophyd.sim")
+redis = lazy_import("redis")
+orjson = lazy_import("orjson")
+redis_json_dict = lazy_import("redis_json_dict")
+tiled_server_module = lazy_import("tiled.server")
+
+_STALE = object()
+
+
+def _plain_json(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    if isinstance(value, collections.abc.Sequence):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class CachedRedisJSONDict(collections.abc.MutableMapping):
+    """A ``RedisJSONDict`` that keeps a copy of every key in this process.
+
+    Reads are served from the copy and cost no round-trip; writes go to Redis
+    straight away and to the copy. Nested values come back wrapped like
+    ``RedisJSONDict``'s, so mutating them writes the whole top-level value back.
+
+    Keys changed by other processes are marked stale and read again on next use.
+    Redis reports the changes through keyspace notifications when the server has
+    them enabled (``notify-keyspace-events`` including ``K`` and ``A``), which
+    also covers plain ``RedisJSONDict`` writers, and otherwise through a pub/sub
+    channel that every ``CachedRedisJSONDict`` on the same prefix publishes to. If
+    the subscription's connection fails, the whole copy is reloaded on next use.
+
+    Parameters
+    ----------
+    url : str
+        Redis URL, e.g. ``redis://info.tst.nsls2.bnl.gov:6379/0``.
+    prefix : str, optional
+        Prefix of the keys holding the dictionary.
+    max_connections : int, optional
+        Size of the connection pool shared by reads, writes and the subscription.
+    """
+
+    def __init__(self, url, prefix="", max_connections=8):
+        self._prefix = prefix
+        self._redis = redis.Redis(
+            connection_pool=redis.ConnectionPool.from_url(
+                url, max_connections=max_connections
+            )
+        )
+        self._lock = threading.RLock()
+        self._cache = None
+        # Notifications still due for this process's own writes, per key.
+        self._own_writes = collections.Counter()
+
+        db = self._redis.connection_pool.connection_kwargs.get("db", 0)
+        self._keyspace = self._keyspace_notifications_enabled()
+        self._channel = f"{prefix}__changed__"
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        if self._keyspace:
+            self._pubsub.psubscribe(
+                **{f"__keyspace@{db}__:{prefix}*": self._on_notification}
+            )
+        else:
+            self._pubsub.subscribe(**{self._channel: self._on_notification})
+        self._thread = self._pubsub.run_in_thread(
+            sleep_time=1, daemon=True, exception_handler=self._on_subscription_error
+        )
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __iter__(self):
+        with self._lock:
+            self._refresh_stale()
+            return iter(list(self._cache))
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_stale()
+            return len(self._cache)
+
+    def __contains__(self, key):
+        with self._lock:
+            cache = self._loaded()
+            if cache.get(key) is _STALE:
+                self._refresh([key])
+            return key in cache
+
+    def __getitem__(self, key):
+        with self._lock:
+            cache = self._loaded()
+            if cache.get(key) is _STALE:
+                self._refresh([key])
+            if key not in cache:
+                raise KeyError(key)
+            value = cache[key]
+
+        def sync():
+            self[key] = observed
+
+        observed = redis_json_dict.redis_json_dict.observe(value, sync)
+        return observed
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._note_write(key)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.delete(f"{self._prefix}{key}")
+            self._publish(pipe, key)
+            pipe.execute()
+            del self._cache[key]
+
+    def update(self, d=(), **kwargs):
+        items = dict(d, **kwargs)
+        if not items:
+            return
+        encoded = {
+            key: orjson.dumps(
+                value, default=_plain_json, option=orjson.OPT_SERIALIZE_NUMPY
+            )
+            for key, value in items.items()
+        }
+        with self._lock:
+            cache = self._loaded()
+            pipe = self._redis.pipeline(transaction=False)
+            for key, json in encoded.items():
+                self._note_write(key)
+                pipe.set(f"{self._prefix}{key}", json)
+                self._publish(pipe, key)
+            pipe.execute()
+            # Cache what a read from Redis would return, e.g. lists for tuples.
+            cache.update((key, orjson.loads(json)) for key, json in encoded.items())
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def close(self):
+        self._thread.stop()
+        self._pubsub.close()
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def _keyspace_notifications_enabled(self):
+        try:
+            flags = self._redis.config_get("notify-keyspace-events")
+        except redis.ResponseError:
+            # CONFIG may be disabled on a managed server.
+            return False
+        flags = next(iter(flags.values()), b"")
+        flags = set(flags.decode() if isinstance(flags, bytes) else flags)
+        return "K" in flags and ("A" in flags or {"g", "$"} <= flags)
+
+    def _loaded(self):
+        if self._cache is None:
+            keys = [
+                key.decode()[len(self._prefix) :]
+                for key in self._redis.scan_iter(match=f"{self._prefix}*")
+            ]
+            values = self._redis.mget([f"{self._prefix}{key}" for key in keys])
+            self._cache = {
+                key: orjson.loads(value)
+                for key, value in zip(keys, values)
+                if value is not None
+            }
+        return self._cache
+
+    def _refresh(self, keys):
+        values = self._redis.mget([f"{self._prefix}{key}" for key in keys])
+        for key, value in zip(keys, values):
+            if value is None:
+                self._cache.pop(key, None)
+            else:
+                self._cache[key] = orjson.loads(value)
+
+    def _refresh_stale(self):
+        cache = self._loaded()
+        stale = [key for key, value in cache.items() if value is _STALE]
+        if stale:
+            self._refresh(stale)
+
+    def _note_write(self, key):
+        self._own_writes[key] += 1
+
+    def _publish(self, pipe, key):
+        if not self._keyspace:
+            pipe.publish(self._channel, key)
+
+    def _on_notification(self, message):
+        if message["type"] == "pmessage":
+            # The channel is ``__keyspace@<db>__:<prefix><key>``.
+            key = message["channel"].decode().split(":", 1)[1][len(self._prefix) :]
+        else:
+            key = message["data"].decode()
+        with self._lock:
+            if self._own_writes[key]:
+                self._own_writes[key] -= 1
+            elif self._cache is not None:
+                self._cache[key] = _STALE
+
+    def _on_subscription_error(self, ex, pubsub, thread):
+        # Changes may have been missed while disconnected.
+        with self._lock:
+            self._cache = None
+            self._own_writes.clear()
+        ttime.sleep(1)
+
 
 DEBUG = True
 
-if DEBUG:
+# RE.md lives in Redis outside DEBUG mode; set TST_REDIS_URL to use a Redis
+# server (e.g. a local redis-server) in DEBUG mode too.
+REDIS_URL = os.environ.get("TST_REDIS_URL")
+
+if DEBUG and not REDIS_URL:
     RE = RunEngine()
 else:
-    RE = RunEngine(RedisJSONDict(redis.Redis("info.tst.nsls2.bnl.gov"), prefix=""))
+    RE = RunEngine(
+        CachedRedisJSONDict(REDIS_URL or "redis://info.tst.nsls2.bnl.gov:6379/0")
+    )
 
 if not is_re_worker_active():
     autoawait_in_bluesky_event_loop()
 
 
-tiled_server = SimpleTiledServer()
-tiled_client = from_uri(tiled_server.uri)
-tiled_writer = TiledWriter(tiled_client)
-RE.subscribe(tiled_writer)
+# Where the catalog lives:
+#   "in-process" - a throwaway SimpleTiledServer inside this process (default),
+#   "external"   - attach to a persistent local server at TST_TILED_URI, starting
+#                  one on TST_TILED_CATALOG_DIR if nothing answers there,
+# falling back to "in-process" if the external server cannot be reached.
+TILED_MODE = os.environ.get("TST_TILED_MODE", "in-process")
+TILED_URI = os.environ.get("TST_TILED_URI", "http://localhost:8000")
+TILED_CATALOG_DIR = Path(
+    os.environ.get("TST_TILED_CATALOG_DIR", Path.home() / ".local/share/tst-tiled")
+)
+TILED_READABLE_STORAGE = os.environ.get(
+    "TST_TILED_READABLE_STORAGE", "/nsls2/data/tst/"
+)
 
 
-def dump_doc_to_stdout(name, doc):
-    print("========= Emitting Doc =============")
-    print(f"{name = }")
-    print(f"{doc = }")
-    print("============ Done ============")
+def tiled_server_healthy(uri, timeout=1.0):
+    """Return True if a Tiled server answers its health check at ``uri``."""
+    try:
+        with urllib.request.urlopen(f"{uri.rstrip('/')}/healthz", timeout=timeout):
+            return True
+    except OSError:
+        return False
 
 
-RE.subscribe(dump_doc_to_stdout)
+def tiled_api_key(catalog_dir=TILED_CATALOG_DIR):
+    """API key shared by the persistent server and every session attaching to it."""
+    if "TILED_API_KEY" in os.environ:
+        return os.environ["TILED_API_KEY"]
+    key_file = Path(catalog_dir) / "api_key"
+    if not key_file.exists():
+        key_file.parent.mkdir(parents=True, exist_ok=True)
+        key_file.touch(mode=0o600)
+        key_file.write_text(secrets.token_hex(32))
+    return key_file.read_text().strip()
 
 
-def now():
-    return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+def start_persistent_tiled_server(
+    uri=TILED_URI, catalog_dir=TILED_CATALOG_DIR, timeout=30
+):
+    """Start ``tiled serve catalog`` on a persistent catalog, detached from this process.
 
+    The server keeps running after the profile exits, so later sessions (and the
+    queueserver worker) attach to the same catalog, as with tiled-serve.sh.
+    """
+    catalog_dir = Path(catalog_dir)
+    (catalog_dir / "data").mkdir(parents=True, exist_ok=True)
+    port = urllib.parse.urlsplit(uri).port or 8000
+    with open(catalog_dir / "server.log", "ab") as log:
+        process = subprocess.Popen(
+            [
+                "tiled",
+                "serve",
+                "catalog",
+                "--init",
+                str(catalog_dir / "catalog.db"),
+                "-w",
+                str(catalog_dir / "data"),
+                "-r",
+                TILED_READABLE_STORAGE,
+                "--api-key",
+                tiled_api_key(catalog_dir),
+                "--port",
+                str(port),
+            ],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    (catalog_dir / "server.pid").write_text(str(process.pid))
 
-class FileLoadingTimer:
+    deadline = ttime.monotonic() + timeout
+    while ttime.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"Tiled server exited with code {process.returncode}, "
+                f"see {catalog_dir / 'server.log'}"
+            )
+        if tiled_server_healthy(uri):
+            return process
+        ttime.sleep(0.2)
+    raise TimeoutError(f"Tiled server at {uri} did not become healthy in {timeout} s")
 
-    def __init__(self):
-        self.start_time = 0
-        self.loading = False
 
-    def start_timer(self, filename):
-        if self.loading:
-            raise Exception("File already loading!")
+def connect_tiled(mode=TILED_MODE):
+    """Return ``(server, client)``; ``server`` is None when attached to an external one."""
+    if mode == "external":
+        try:
+            if not tiled_server_healthy(TILED_URI):
+                print(f"Starting a persistent Tiled server at {TILED_URI} ...")
+                start_persistent_tiled_server()
+            # One client, and so one HTTP connection pool, for the whole session.
+            return None, from_uri(TILED_URI, api_key=tiled_api_key())
+        except Exception as ex:
+            print(f"Falling back to an in-process Tiled server: {ex!r}")
+    elif mode != "in-process":
+        raise ValueError(f"Unknown TST_TILED_MODE {mode!r}")
 
-        print(f"Loading {filename}...")
-        self.start_time = ttime.time()
-        self.loading = True
+    # Like the persistent server, serve the files that scans write to the storage.
+    server = tiled_server_module.SimpleTiledServer(
+        readable_storage=[TILED_READABLE_STORAGE]
+    )
+    # The server's thread is not a daemon, so exiting would wait for it forever;
+    # stop it before that wait, after which an ``atexit`` function would run.
+    threading._register_atexit(server.close)
+    return server, from_uri(server.uri)
 
-    def stop_timer(self, filename):
 
-        elapsed = ttime.time() - self.start_time
-        print(f"Done loading {filename} in {elapsed} seconds.")
-        self.loading = False
+tiled_server, tiled_client = connect_tiled()
+# Subscribed to the RunEngine through the queued ``tiled_writer_stage`` in
+# 01-callbacks.py so that catalog writes happen off the RunEngine's thread.
+tiled_writer = TiledWriter(tiled_client)
 
 
-warnings.filterwarnings("ignore")
+def dump_doc_to_stdout(name, doc):
+    print("========= Emitting Doc =============")
+    print(f"{name = }")
+    print(f"{doc = }")
+    print("============ Done ============")
 
 
-def warmup_hdf5_plugins(detectors):
-    """
-    Warm-up the hdf5 plugins.
-    This is necessary for when the corresponding IOC restarts we have to trigger one image
-    for the hdf5 plugin to work correctly, else we get file writing errors.
-    Parameter:
-    ----------
-    detectors: list
-    """
-    for det in detectors:
-        _array_size = det.hdf5.array_size.get()
-        if 0 in [_array_size.height, _array_size.width] and hasattr(det, "hdf5"):
-            print(
-                f"\n  Warming up HDF5 plugin for {det.name} as the array_size={_array_size}..."
-            )
-            det.hdf5.warmup()
-            print(
-                f"  Warming up HDF5 plugin for {det.name} is done. array_size={det.hdf5.array_size.get()}\n"
-            )
-        else:
-            print(
-                f"\n  Warming up of the HDF5 plugin is not needed for {det.name} as the array_size={_array_size}."
-            )
+# Documents are printed by the queued ``document_printer`` subscribed in
+# 01-callbacks.py; subscribing this function directly puts terminal I/O on the
+# RunEngine's thread.
+
+
+def now():
+    return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+warnings.filterwarnings("ignore")
 
 
 def show_env():
@@ -122,4 +631,13 @@ RUNNING_IN_NSLS2_CI = os.environ.get("RUNNING_IN_NSLS2_CI", "NO") == "YES" or DE
 if RUNNING_IN_NSLS2_CI:
     print("Running in CI, using mock mode when initializing devices...")
 
-file_loading_timer = FileLoadingTimer()
+# Drive the mocked devices with the hardware simulation in 19-simulation.py; the
+# simulated PandA and cameras write their files below SIMULATION_DATA_DIR.
+SIMULATE = os.environ.get("TST_SIMULATE", "NO") == "YES"
+SIMULATION_DATA_DIR = Path(
+    os.environ.get(
+        "TST_SIMULATION_DATA_DIR", Path(tempfile.gettempdir()) / "tst-simulation"
+    )
+)
+
+startup_profiler.stop_file(__file__)
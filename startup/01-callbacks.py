@@ -0,0 +1,470 @@
+startup_profiler.start_file(__file__)
+
+import copy
+import logging
+import pprint
+import queue
+import statistics
+import sys
+import threading
+import time as ttime
+from collections import deque
+
+
+class QueuedDocumentPrinter:
+    """Print (or log) RunEngine documents from a background thread.
+
+    Subscribing this instead of a plain printing callback keeps terminal I/O off the
+    RunEngine's thread: ``__call__`` only does a non-blocking ``put`` on a bounded
+    queue, and a full queue drops the document instead of stalling the plan.  The
+    worker drains the queue in batches, coalesces consecutive ``event`` and
+    ``stream_datum`` documents of the same stream into a single line and caps how
+    many lines it writes per second.
+
+    Parameters
+    ----------
+    verbosity : dict, optional
+        Maps document names to ``"full"`` (pretty-printed document), ``"summary"``
+        (one line) or ``"off"``. Missing names use ``DEFAULT_VERBOSITY``.
+    maxsize : int
+        Capacity of the queue between the RunEngine and the worker.
+    flush_interval : float
+        Seconds the worker waits after the first document of a batch to let
+        more documents accumulate before formatting them.
+    max_lines_per_second : float
+        Output budget; lines over budget are suppressed and counted.
+    logger : logging.Logger, optional
+        Emit through ``logger.info`` instead of writing to ``sys.stdout``.
+    """
+
+    DEFAULT_VERBOSITY = {
+        "start": "full",
+        "stop": "full",
+        "descriptor": "summary",
+        "event": "summary",
+        "event_page": "summary",
+        "resource": "summary",
+        "datum": "off",
+        "datum_page": "off",
+        "stream_resource": "summary",
+        "stream_datum": "summary",
+    }
+
+    # Documents that are emitted at a high rate during fly scans and that are
+    # merged into one line while they keep arriving for the same stream.
+    COALESCE_KEYS = {
+        "event": "descriptor",
+        "event_page": "descriptor",
+        "datum": "resource",
+        "stream_datum": "stream_resource",
+    }
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        verbosity=None,
+        maxsize=10_000,
+        flush_interval=0.5,
+        max_lines_per_second=50,
+        logger=None,
+    ):
+        self.verbosity = {**self.DEFAULT_VERBOSITY, **(verbosity or {})}
+        self.flush_interval = flush_interval
+        self.max_lines_per_second = max_lines_per_second
+        self.logger = logger
+
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.suppressed = 0
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._line_budget = max_lines_per_second
+        self._last_emit = ttime.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="document-printer", daemon=True
+        )
+        self._thread.start()
+
+    def __call__(self, name, doc):
+        self.received += 1
+        try:
+            self._queue.put_nowait((name, doc))
+        except queue.Full:
+            self.dropped += 1
+
+    def set_verbosity(self, name, level):
+        if level not in ("full", "summary", "off"):
+            raise ValueError(f"Unknown verbosity level {level!r}")
+        self.verbosity[name] = level
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "suppressed": self.suppressed,
+            "queued": self._queue.qsize(),
+        }
+
+    def flush(self, timeout=None):
+        """Block until every queued document has been printed or dropped.
+
+        Returns ``False`` if ``timeout`` expired first.
+        """
+        deadline = None if timeout is None else ttime.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and ttime.monotonic() > deadline:
+                return False
+            ttime.sleep(0.01)
+        return True
+
+    def close(self, timeout=5):
+        """Flush what is queued and stop the worker thread."""
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is not self._STOP:
+                ttime.sleep(self.flush_interval)
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = any(item is self._STOP for item in batch)
+            try:
+                lines = self._format_batch(
+                    [item for item in batch if item is not self._STOP]
+                )
+                self._emit(lines)
+            except Exception as ex:
+                print(
+                    f"Document printer failed to write output: {ex!r}", file=sys.stderr
+                )
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _format_batch(self, batch):
+        lines = []
+        group_key, group = None, []
+
+        def flush_group():
+            if group:
+                lines.append(self._summarize_group(group_key[0], group))
+                self.coalesced += len(group) - 1
+
+        for name, doc in batch:
+            level = self.verbosity.get(name, "summary")
+            if level == "off":
+                continue
+            key_field = self.COALESCE_KEYS.get(name)
+            if level == "summary" and key_field is not None:
+                key = (name, doc.get(key_field))
+                if key != group_key:
+                    flush_group()
+                    group_key, group = key, []
+                group.append(doc)
+                continue
+
+            flush_group()
+            group_key, group = None, []
+            if level == "full":
+                lines.extend(self._format_full(name, doc))
+            else:
+                lines.append(self._format_summary(name, doc))
+            if name == "stop":
+                lines.append(f"document printer stats: {self.stats()}")
+        flush_group()
+        return lines
+
+    def _emit(self, lines):
+        if not lines:
+            return
+        now = ttime.monotonic()
+        self._line_budget = min(
+            self.max_lines_per_second,
+            self._line_budget + (now - self._last_emit) * self.max_lines_per_second,
+        )
+        self._last_emit = now
+
+        allowed = max(int(self._line_budget), 1)
+        if len(lines) > allowed:
+            self.suppressed += len(lines) - allowed
+            lines = lines[:allowed] + [f"... {len(lines) - allowed} lines suppressed"]
+        self._line_budget -= len(lines)
+
+        if self.logger is not None:
+            for line in lines:
+                self.logger.info(line)
+        else:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+    @staticmethod
+    def _format_full(name, doc):
+        return [
+            "========= Emitting Doc =============",
+            f"{name = }",
+            f"doc = {pprint.pformat(doc)}",
+            "============ Done ============",
+        ]
+
+    @staticmethod
+    def _format_summary(name, doc):
+        fields = {
+            "start": ("uid", "scan_id", "plan_name"),
+            "stop": ("run_start", "exit_status", "num_events"),
+            "descriptor": ("name", "uid"),
+            "resource": ("uid", "spec", "resource_path"),
+            "stream_resource": ("uid", "data_key", "uri"),
+        }.get(name, ("uid",))
+        summary = ", ".join(f"{field}={doc.get(field)!r}" for field in fields)
+        return f"{name}: {summary}"
+
+    @staticmethod
+    def _summarize_group(name, docs):
+        first, last = docs[0], docs[-1]
+        if "indices" in first:
+            span = f"indices {first['indices']['start']}-{last['indices']['stop']}"
+        elif "seq_num" in first:
+            start, stop = first["seq_num"], last["seq_num"]
+            if isinstance(start, list):
+                start, stop = start[0], stop[-1]
+            span = f"seq_num {start}-{stop}"
+        else:
+            span = f"uid {first.get('uid')!r}"
+        owner = (
+            first.get("stream_resource")
+            or first.get("descriptor")
+            or first.get("resource")
+        )
+        return f"{name} x{len(docs)} for {owner!r}: {span}"
+
+
+document_printer = QueuedDocumentPrinter()
+RE.subscribe(document_printer)
+
+
+class QueuedTiledWriter:
+    """Run a ``TiledWriter`` on its own thread, fed through an unbounded queue.
+
+    ``__call__`` only enqueues, so a slow catalog never stalls the RunEngine while
+    a run is open.  The worker drains the queue in batches (preserving document
+    order), merges the ``stream_datum`` documents that extend the same stream
+    resource into a single update, also when those of several resources (e.g. the
+    PandA's and a camera's) are interleaved, and retries writes that fail with
+    transient (connection or server-side) errors with exponential backoff.
+    Documents that still fail are kept in ``failed`` and can be sent again with
+    ``replay_failed``; nothing is discarded.
+
+    A ``stop`` document waits for the queue to drain, so a run is complete in the
+    catalog when the RunEngine returns, and the queue is drained again when the
+    interpreter exits.
+
+    Parameters
+    ----------
+    writer : callable
+        The ``(name, doc)`` callback doing the actual writes, e.g. ``TiledWriter``.
+    max_batch : int
+        Maximum number of documents taken off the queue per batch.
+    retries : int
+        Number of retries of a transient failure before the document is parked
+        in ``failed``.
+    backoff : float
+        Delay before the first retry in seconds, doubled on every attempt.
+    stop_timeout : float, optional
+        Seconds a ``stop`` document waits for the queue to drain; None waits as
+        long as it takes.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self, writer, max_batch=1000, retries=5, backoff=0.2, stop_timeout=60
+    ):
+        self.writer = writer
+        self.max_batch = max_batch
+        self.retries = retries
+        self.backoff = backoff
+        self.stop_timeout = stop_timeout
+        self.failed = []
+
+        self.documents_received = 0
+        self.documents_written = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.max_queue_depth = 0
+        self.last_batch_size = 0
+        self._write_latencies = deque(maxlen=1000)
+        self._lags = deque(maxlen=1000)
+
+        self._logger = logging.getLogger("tst_profile.tiled_writer")
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="tiled-writer", daemon=True
+        )
+        self._thread.start()
+        # Before the interpreter waits for non-daemon threads (the in-process Tiled
+        # server's among them), where an ``atexit`` function would run too late.
+        threading._register_atexit(self.close)
+
+    def __call__(self, name, doc):
+        self.documents_received += 1
+        self._queue.put((name, doc, ttime.monotonic()))
+        depth = self._queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        if name == "stop" and not self.flush(self.stop_timeout):
+            self._logger.warning(
+                "%d documents are still queued for Tiled after the run stopped",
+                self._queue.qsize(),
+            )
+
+    def flush(self, timeout=None):
+        """Block until every queued document has been handed to the writer.
+
+        Returns ``False`` if ``timeout`` expired first.
+        """
+        deadline = None if timeout is None else ttime.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and ttime.monotonic() > deadline:
+                return False
+            ttime.sleep(0.01)
+        return True
+
+    def close(self, timeout=None):
+        """Write what is queued and stop the worker thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def replay_failed(self):
+        """Re-queue the documents whose writes failed permanently."""
+        failed, self.failed = self.failed, []
+        for name, doc in failed:
+            self._queue.put((name, doc, ttime.monotonic()))
+
+    def metrics(self):
+        latencies = list(self._write_latencies)
+        lags = list(self._lags)
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "last_batch_size": self.last_batch_size,
+            "documents_received": self.documents_received,
+            "documents_written": self.documents_written,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "failed": len(self.failed),
+            "write_latency_mean": statistics.fmean(latencies) if latencies else None,
+            "write_latency_max": max(latencies, default=None),
+            "queue_lag_max": max(lags, default=None),
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = any(item is self._STOP for item in batch)
+            self.last_batch_size = len(batch) - stopping
+            try:
+                documents = [item for item in batch if item is not self._STOP]
+                for name, doc, enqueued in self._coalesce(documents):
+                    self._lags.append(ttime.monotonic() - enqueued)
+                    self._write(name, doc)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _coalesce(self, batch):
+        merged = []
+        copied = set()
+        # Index in ``merged`` of the last stream_datum of each stream resource;
+        # any other document ends the stretch in which they can be merged.
+        latest = {}
+        for name, doc, enqueued in batch:
+            if name != "stream_datum":
+                latest.clear()
+                merged.append((name, doc, enqueued))
+                continue
+            index = latest.get(doc["stream_resource"])
+            previous = merged[index][1] if index is not None else None
+            if (
+                previous is not None
+                and previous["indices"]["stop"] == doc["indices"]["start"]
+                and previous["seq_nums"]["stop"] == doc["seq_nums"]["start"]
+            ):
+                # Never mutate a document other callbacks may still hold on to.
+                if id(previous) not in copied:
+                    previous = copy.deepcopy(previous)
+                    copied.add(id(previous))
+                    merged[index] = (name, previous, merged[index][2])
+                previous["indices"]["stop"] = doc["indices"]["stop"]
+                previous["seq_nums"]["stop"] = doc["seq_nums"]["stop"]
+                self.coalesced += 1
+                continue
+            latest[doc["stream_resource"]] = len(merged)
+            merged.append((name, doc, enqueued))
+        return merged
+
+    def _write(self, name, doc):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            start = ttime.monotonic()
+            try:
+                self.writer(name, doc)
+            except Exception as ex:
+                if not self._is_transient(ex) or attempt == self.retries:
+                    self._logger.exception(
+                        "Failed to write %r document %r to Tiled", name, doc.get("uid")
+                    )
+                    self.failed.append((name, doc))
+                    return
+                self.retried += 1
+                self._logger.warning(
+                    "Transient error writing %r document, retrying in %.1fs: %r",
+                    name,
+                    delay,
+                    ex,
+                )
+                ttime.sleep(delay)
+                delay *= 2
+            else:
+                self._write_latencies.append(ttime.monotonic() - start)
+                self.documents_written += 1
+                return
+
+    @staticmethod
+    def _is_transient(ex):
+        if isinstance(ex, (ConnectionError, TimeoutError)):
+            return True
+        # httpx is what the tiled client talks through; avoid importing it here.
+        for cls in type(ex).__mro__:
+            if cls.__module__.startswith("httpx") and cls.__name__ in (
+                "TransportError",
+                "TimeoutException",
+            ):
+                return True
+        response = getattr(ex, "response", None)
+        return getattr(response, "status_code", 0) >= 500
+
+
+tiled_writer_stage = QueuedTiledWriter(tiled_writer)
+RE.subscribe(tiled_writer_stage)
+
+
+startup_profiler.stop_file(__file__)
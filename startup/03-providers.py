@@ -1,13 +1,47 @@
-file_loading_timer.start_timer(__file__)
+startup_profiler.start_file(__file__)
 
+import datetime
+import itertools
 import os
+import secrets
+import threading
 from pathlib import Path
 
 from nslsii.ophyd_async.providers import NSLS2PathProvider
-from ophyd_async.core import PathInfo
+from ophyd_async.core import FilenameProvider, PathInfo
+
+
+class CounterFilenameProvider(FilenameProvider):
+    """Unique filenames from a per-session token and a counter.
+
+    The token keeps names from different sessions apart; within a session the
+    counter does, so no filename needs the filesystem to be checked.
+    """
+
+    def __init__(self, session=None):
+        self.session = session or secrets.token_hex(4)
+        self._counter = itertools.count()
+
+    def __call__(self, device_name: str = None) -> str:
+        return f"{self.session}_{next(self._counter):06d}"
 
 
 class TSTPathProvider(NSLS2PathProvider):
+    """``NSLS2PathProvider`` resolving each device's directory once per session.
+
+    The directory is remembered per device, cycle, data session and date, so a
+    change to ``RE.md`` or a new day resolves it afresh. A new directory is
+    created here, so the writers are told not to create any (``create_dir_depth``
+    0); where that fails (the proposal filesystem is not mounted or not writable
+    from this host) the IOC creates it on first use, as before. ``forget`` drops
+    what is remembered, e.g. after a directory was removed.
+    """
+
+    def __init__(self, metadata_dict, *args, **kwargs):
+        super().__init__(metadata_dict, *args, **kwargs)
+        self._filename_provider = CounterFilenameProvider()
+        self._directories = {}
+        self._lock = threading.Lock()
 
     def get_beamline_proposals_dir(self):
         """
@@ -20,17 +54,38 @@ class TSTPathProvider(NSLS2PathProvider):
         beamline_proposals_dir = Path(
             f"/nsls2/data/{beamline_tla}/legacy/mock-proposals"
         )
+        if SIMULATE:
+            beamline_proposals_dir = SIMULATION_DATA_DIR / "mock-proposals"
 
         return beamline_proposals_dir
 
+    def forget(self):
+        with self._lock:
+            self._directories.clear()
+
     def __call__(self, device_name: str = None) -> PathInfo:
-        directory_path = self.generate_directory_path(device_name=device_name)
+        key = (
+            device_name,
+            self._metadata_dict.get("cycle"),
+            self._metadata_dict.get("data_session"),
+            datetime.date.today(),
+        )
+        with self._lock:
+            if key not in self._directories:
+                directory_path = self.generate_directory_path(device_name=device_name)
+                try:
+                    directory_path.mkdir(parents=True, exist_ok=True)
+                    create_dir_depth = 0
+                except OSError:
+                    create_dir_depth = -7
+                self._directories[key] = (directory_path, create_dir_depth)
+            directory_path, create_dir_depth = self._directories[key]
 
         return PathInfo(
             directory_path=directory_path,
             filename=self._filename_provider(),
-            create_dir_depth=-7,
+            create_dir_depth=create_dir_depth,
         )
 
 
-file_loading_timer.stop_timer(__file__)
+startup_profiler.stop_file(__file__)
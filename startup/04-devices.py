@@ -0,0 +1,168 @@
+startup_profiler.start_file(__file__)
+
+import asyncio
+import inspect
+import time as ttime
+
+import bluesky.plan_stubs as bps
+from bluesky.preprocessors import plan_mutator
+from bluesky.run_engine import call_in_bluesky_event_loop
+from ophyd_async.core import DEFAULT_TIMEOUT
+
+
+def call_async(coroutine_function, *args, **kwargs):
+    """Plan stub awaiting ``coroutine_function(*args, **kwargs)`` in the RunEngine loop.
+
+    Unlike a bare ``bps.wait_for``, this returns the coroutine's result and re-raises
+    its exception in the plan.
+    """
+    outcome = {}
+
+    async def _call():
+        try:
+            outcome["result"] = await coroutine_function(*args, **kwargs)
+        except Exception as ex:
+            outcome["error"] = ex
+
+    yield from bps.wait_for([_call])
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+class DeviceRegistry:
+    """Connect all of the profile's ophyd-async devices in one event-loop pass.
+
+    Startup files construct their devices and ``add`` them here instead of
+    connecting each one in its own ``init_devices`` block.  ``connect_all`` then
+    connects every registered device concurrently, each with its own timeout, so
+    startup takes as long as the slowest device rather than the sum of all of them.
+    Devices that fail or time out are deferred: ``lazy_connect``, installed as a
+    RunEngine preprocessor, connects a device the first time a plan sends it (or
+    one of its signals) a message.
+
+    Functions registered with ``add_connect_callback`` are called with each device
+    once it has connected, e.g. to index its signals.
+    """
+
+    def __init__(self, mock=False, timeout=DEFAULT_TIMEOUT):
+        self.mock = mock
+        self.timeout = timeout
+        self.connect_times = {}
+        self.errors = {}
+        self._devices = {}
+        self._connected = set()
+        self._connect_callbacks = []
+
+    def add(self, device):
+        self._devices[device.name] = device
+        return device
+
+    def add_connect_callback(self, callback):
+        """Call ``callback(device)`` for every connected and every future device.
+
+        ``callback`` may be a coroutine function; it runs in the bluesky event loop.
+        """
+        self._connect_callbacks.append(callback)
+        connected = [self._devices[name] for name in self.connected]
+        if connected:
+
+            async def _replay():
+                for device in connected:
+                    await self._run_connect_callback(callback, device)
+
+            call_in_bluesky_event_loop(_replay())
+
+    @property
+    def devices(self):
+        return dict(self._devices)
+
+    @property
+    def connected(self):
+        return [name for name in self._devices if name in self._connected]
+
+    @property
+    def deferred(self):
+        return [name for name in self._devices if name not in self._connected]
+
+    def connect_all(self, timeout=None):
+        """Connect every registered device that is not connected yet."""
+        timeout = self.timeout if timeout is None else timeout
+        pending = [self._devices[name] for name in self.deferred]
+        if not pending:
+            return
+
+        async def _connect_pending():
+            return await asyncio.gather(
+                *(self._connect(device, timeout) for device in pending),
+                return_exceptions=True,
+            )
+
+        with startup_profiler.section("connect devices", category="connect") as s:
+            results = call_in_bluesky_event_loop(_connect_pending())
+            s.details["connect_times"] = {
+                device.name: self.connect_times.get(device.name) for device in pending
+            }
+        for device, result in zip(pending, results):
+            if isinstance(result, BaseException):
+                print(f"Deferring connection of {device.name}: {result!r}")
+        connected = len(pending) - len(self.deferred)
+        print(f"Connected {connected}/{len(pending)} devices.")
+
+    def lazy_connect(self, plan):
+        """RunEngine preprocessor connecting deferred devices on first use."""
+
+        def connect_then_send(device, msg):
+            yield from call_async(self._connect, device, self.timeout, True)
+            return (yield msg)
+
+        def msg_proc(msg):
+            device = self._root_device(msg.obj)
+            if device is None or device.name in self._connected:
+                return None, None
+            if self._devices.get(device.name) is not device:
+                return None, None
+            return connect_then_send(device, msg), None
+
+        return (yield from plan_mutator(plan, msg_proc))
+
+    async def _connect(self, device, timeout, force_reconnect=False):
+        start = ttime.monotonic()
+        try:
+            await asyncio.wait_for(
+                device.connect(
+                    mock=self.mock, timeout=timeout, force_reconnect=force_reconnect
+                ),
+                timeout,
+            )
+        except BaseException as ex:
+            self.errors[device.name] = ex
+            raise
+        self.connect_times[device.name] = ttime.monotonic() - start
+        self.errors.pop(device.name, None)
+        self._connected.add(device.name)
+        for callback in self._connect_callbacks:
+            await self._run_connect_callback(callback, device)
+
+    @staticmethod
+    async def _run_connect_callback(callback, device):
+        try:
+            result = callback(device)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as ex:
+            print(f"Connect callback {callback!r} failed for {device.name}: {ex!r}")
+
+    @staticmethod
+    def _root_device(obj):
+        if obj is None or not hasattr(obj, "parent"):
+            return None
+        while obj.parent is not None:
+            obj = obj.parent
+        return obj
+
+
+device_registry = DeviceRegistry(mock=RUNNING_IN_NSLS2_CI or SIMULATE)
+
+
+startup_profiler.stop_file(__file__)
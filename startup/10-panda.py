@@ -1,27 +1,5 @@
-print(f"Loading file {__file__!r} ...")
-
-import asyncio
-import datetime
-import json
-import time as ttime
-from enum import Enum
-from pathlib import Path
-from threading import Thread
-from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional
-
-import bluesky.plan_stubs as bps
-import bluesky.preprocessors as bpp
-from bluesky import RunEngine
-from bluesky.utils import ProgressBarManager
-from ophyd_async.core import (
-    DEFAULT_TIMEOUT,
-    AsyncStatus,
-    DetectorController,
-    DetectorTrigger,
-    DetectorWriter,
-    SignalRW,
-    StandardDetector,
-)
+startup_profiler.start_file(__file__)
+
 from ophyd_async.fastcs.panda import HDFPanda
 
 ##########################################################################
@@ -38,18 +16,16 @@ from ophyd_async.fastcs.panda import HDFPanda
 
 
 def instantiate_panda_async(panda_id):
-    print(f"Connecting to PandA #{panda_id}")
-    with init_devices(mock=RUNNING_IN_NSLS2_CI):
-        panda = HDFPanda(
-            f"XF:31ID1-ES{{PANDA:{panda_id}}}:",
-            TSTPathProvider(RE.md),
-            name=f"panda{panda_id}",
-        )
-    print("Done")
-    return panda
+    print(f"Registering PandA #{panda_id}")
+    panda = HDFPanda(
+        f"XF:31ID1-ES{{PANDA:{panda_id}}}:",
+        TSTPathProvider(RE.md),
+        name=f"panda{panda_id}",
+    )
+    return device_registry.add(panda)
 
 
 panda1 = instantiate_panda_async(1)
 
 
-file_loading_timer.stop_timer(__file__)
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,158 @@
+startup_profiler.start_file(__file__)
+
+import dataclasses
+
+import numpy as np
+from ophyd_async.core import Device
+from ophyd_async.epics.core import epics_signal_r
+
+# The position fields the PandAs capture.
+CAPTURED_POSITIONS = ("INENC1.VAL", "CALC1.OUT")
+
+
+@dataclasses.dataclass(frozen=True)
+class PositionCalibration:
+    """Conversion of a PandA position field from encoder counts to ``units``.
+
+    ``value = counts * scale + offset``, as the PandA's own SCALE and OFFSET
+    define it. A PandA that leaves the field unscaled (scale 1, offset 0) reports
+    counts, and ``nominal`` stands in for it.
+    """
+
+    field: str
+    scale: float
+    offset: float = 0.0
+    units: str = ""
+    source: str = "panda"
+
+    @classmethod
+    def nominal(cls, field):
+        """The rotation stage's nominal ``COUNTS_PER_DEG``, for unscaled fields."""
+        return cls(field, 1 / COUNTS_PER_DEG, 0.0, "deg", "nominal")
+
+    @property
+    def counts_per_unit(self):
+        return 1 / self.scale
+
+    @property
+    def dataset_prefix(self):
+        """How the field's datasets in the PandA's HDF5 file are named."""
+        return self.field.replace(".", "_")
+
+    def to_counts(self, value):
+        return (np.asarray(value) - self.offset) / self.scale
+
+    def apply(self, counts, out=None, chunk_rows=65536):
+        """Convert ``counts`` to ``units``, ``chunk_rows`` rows at a time.
+
+        ``counts`` may be anything sliceable into arrays, e.g. an ``h5py`` dataset,
+        which is then read chunk by chunk without ever holding its counts whole.
+        """
+        if out is None:
+            out = np.empty(len(counts), dtype="f8")
+        for start in range(0, len(counts), chunk_rows):
+            chunk = out[start : start + chunk_rows]
+            np.multiply(counts[start : start + chunk_rows], self.scale, out=chunk)
+            if self.offset:
+                np.add(chunk, self.offset, out=chunk)
+        return out
+
+
+class CalibrationTransform:
+    """Add the calibrated values of the position datasets of a PandA data chunk.
+
+    Takes and returns ``{dataset_name: ndarray}`` as ``PandaLiveReader`` reads
+    them; each dataset of a calibrated field gains a copy in its units, named
+    ``<dataset>_<units>``, e.g. ``INENC1_VAL_deg``.
+    """
+
+    def __init__(self, calibrations, chunk_rows=65536):
+        self.calibrations = list(calibrations)
+        self.chunk_rows = chunk_rows
+
+    def __call__(self, chunk):
+        calibrated = dict(chunk)
+        for name, values in chunk.items():
+            for calibration in self.calibrations:
+                if name.replace(".", "_").startswith(calibration.dataset_prefix):
+                    units = calibration.units or "calibrated"
+                    calibrated[f"{name}_{units}"] = calibration.apply(
+                        values, chunk_rows=self.chunk_rows
+                    )
+                    break
+        return calibrated
+
+
+class PositionCalibrationIO(Device):
+    def __init__(self, prefix, name=""):
+        self.scale = epics_signal_r(float, prefix + "SCALE")
+        self.offset = epics_signal_r(float, prefix + "OFFSET")
+        self.units = epics_signal_r(str, prefix + "UNITS")
+        super().__init__(name=name)
+
+
+class PandaCalibrationIO(Device):
+    """SCALE, OFFSET and UNITS of the position fields a PandA captures.
+
+    The records of a field are those of its row of the PandA's POSITIONS table,
+    e.g. ``INENC1:VAL:SCALE`` is ``POSITIONS:20:SCALE``.
+    """
+
+    def __init__(self, prefix, fields=CAPTURED_POSITIONS, name=""):
+        self.fields = {}
+        for field in fields:
+            attr = field.lower().replace(".", "_")
+            setattr(
+                self,
+                attr,
+                PositionCalibrationIO(prefix + field.replace(".", ":") + ":"),
+            )
+            self.fields[field] = attr
+        super().__init__(name=name)
+
+
+def instantiate_panda_calibration(panda_id):
+    calibration = PandaCalibrationIO(
+        f"XF:31ID1-ES{{PANDA:{panda_id}}}:",
+        name=f"panda{panda_id}_calibration",
+    )
+    return device_registry.add(calibration)
+
+
+panda1_calibration = instantiate_panda_calibration(1)
+panda_calibrations = {"panda1": panda1_calibration}
+
+
+def read_panda_calibration(panda):
+    """Read the calibration of every position field ``panda`` captures.
+
+    Returns ``{field: PositionCalibration}``, in ``CAPTURED_POSITIONS`` order;
+    read it once per run and record ``calibration_metadata`` of it with the run.
+    """
+    calibration_io = panda_calibrations.get(panda.name)
+    if calibration_io is None:
+        return {
+            field: PositionCalibration.nominal(field) for field in CAPTURED_POSITIONS
+        }
+    calibrations = {}
+    for field, attr in calibration_io.fields.items():
+        io = getattr(calibration_io, attr)
+        scale = yield from bps.rd(io.scale)
+        offset = yield from bps.rd(io.offset)
+        units = yield from bps.rd(io.units)
+        if scale in (0, 1) and not offset:
+            calibrations[field] = PositionCalibration.nominal(field)
+        else:
+            calibrations[field] = PositionCalibration(field, scale, offset, units)
+    return calibrations
+
+
+def calibration_metadata(calibrations):
+    """``calibrations`` for the start document, keyed by dataset (no dots allowed)."""
+    return {
+        calibration.dataset_prefix: dataclasses.asdict(calibration)
+        for calibration in calibrations.values()
+    }
+
+
+startup_profiler.stop_file(__file__)
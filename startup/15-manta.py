@@ -1,33 +1,189 @@
-file_loading_timer.start_timer(__file__)
+startup_profiler.start_file(__file__)
 
+import dataclasses
 
-print(f"Loading file {__file__!r} ...")
+import numpy as np
+from ophyd_async.core import AsyncStatus, Device, StrictEnum, TriggerInfo
+from ophyd_async.epics.adcore import ADCompression
+from ophyd_async.epics.advimba import VimbaDetector
+from ophyd_async.epics.core import epics_signal_rw
 
 
-import asyncio
-from dataclasses import dataclass
-from enum import Enum
+class BloscCompressor(StrictEnum):
+    BLOSCLZ = "blosclz"
+    LZ4 = "lz4"
+    LZ4HC = "lz4hc"
+    SNAPPY = "snappy"
+    ZLIB = "zlib"
+    ZSTD = "zstd"
 
-from ophyd_async.epics.advimba import VimbaDetector
 
+class BloscShuffle(StrictEnum):
+    NONE = "None"
+    BYTE = "Byte"
+    BIT = "Bit"
 
-def instantiate_manta_async(manta_id):
-    print(f"Connecting to manta device {manta_id}")
-    with init_devices(mock=RUNNING_IN_NSLS2_CI):
-        manta_async = VimbaDetector(
-            f"XF:31ID1-ES{{GigE-Cam:{manta_id}}}",
-            TSTPathProvider(RE.md),
-            name=f"manta{manta_id}",
+
+class HDF5CompressionIO(Device):
+    """The NDFileHDF5 compression and chunking records ophyd-async leaves out."""
+
+    def __init__(self, prefix, name=""):
+        self.zlevel = epics_signal_rw(int, prefix + "ZLevel_RBV", prefix + "ZLevel")
+        self.blosc_compressor = epics_signal_rw(
+            BloscCompressor, prefix + "BloscCompressor_RBV", prefix + "BloscCompressor"
+        )
+        self.blosc_level = epics_signal_rw(
+            int, prefix + "BloscCompressLevel_RBV", prefix + "BloscCompressLevel"
+        )
+        self.blosc_shuffle = epics_signal_rw(
+            BloscShuffle, prefix + "BloscShuffle_RBV", prefix + "BloscShuffle"
+        )
+        self.num_frames_chunks = epics_signal_rw(
+            int, prefix + "NumFramesChunks_RBV", prefix + "NumFramesChunks"
+        )
+        self.num_row_chunks = epics_signal_rw(
+            int, prefix + "NumRowChunks_RBV", prefix + "NumRowChunks"
+        )
+        self.num_col_chunks = epics_signal_rw(
+            int, prefix + "NumColChunks_RBV", prefix + "NumColChunks"
+        )
+        super().__init__(name=name)
+
+
+@dataclasses.dataclass(frozen=True)
+class HDF5Settings:
+    compression: ADCompression
+    level: int = 0
+    blosc_compressor: BloscCompressor = BloscCompressor.LZ4
+    shuffle: BloscShuffle = BloscShuffle.NONE
+    frames_per_chunk: int = 1
+
+
+@dataclasses.dataclass
+class HDF5WriterProfile:
+    """Choose the HDF5 settings of a scan from its frame size and frame rate.
+
+    The faster the data arrive compared with ``disk_bandwidth`` (bytes per
+    second the proposal filesystem sustains), the cheaper the codec: zstd when
+    there is time to spare, blosc-lz4 when the data rate approaches a quarter of
+    the disk bandwidth and bitshuffle-lz4 when an unknown or higher rate needs
+    the disk traffic cut without falling behind the camera.
+
+    A chunk holds as many whole frames as fit in ``chunk_bytes``, but no more
+    than arrive in ``chunk_seconds``, so live readers are not kept waiting for a
+    chunk to fill. The rows and columns of a chunk are always the whole frame:
+    ``ADHDFWriter`` turns on the plugin's automatic chunk sizing.
+    """
+
+    disk_bandwidth: float = 500e6
+    chunk_bytes: int = 4 * 2**20
+    chunk_seconds: float = 1.0
+
+    def choose(self, frame_shape, dtype, frame_rate=None):
+        """The settings for frames of ``frame_shape`` and ``dtype``.
+
+        Parameters
+        ----------
+        frame_shape : tuple of int
+            Rows and columns of a frame.
+        dtype : numpy.dtype
+            Data type of a pixel.
+        frame_rate : float, optional
+            Frames per second, or None if the scan does not say.
+
+        Returns
+        -------
+        HDF5Settings
+        """
+        dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+        # Byte shuffling a single byte type does nothing; shuffle bits instead.
+        shuffle = BloscShuffle.BIT if dtype.itemsize == 1 else BloscShuffle.BYTE
+
+        frames_per_chunk = max(self.chunk_bytes // max(frame_bytes, 1), 1)
+        if frame_rate:
+            frames_per_chunk = min(
+                frames_per_chunk, max(int(frame_rate * self.chunk_seconds), 1)
+            )
+
+        data_rate = frame_bytes * frame_rate if frame_rate else None
+        if data_rate is None or data_rate > self.disk_bandwidth:
+            return HDF5Settings(ADCompression.BSLZ4, frames_per_chunk=frames_per_chunk)
+        if data_rate > self.disk_bandwidth / 4:
+            return HDF5Settings(
+                ADCompression.BLOSC,
+                level=5,
+                blosc_compressor=BloscCompressor.LZ4,
+                shuffle=shuffle,
+                frames_per_chunk=frames_per_chunk,
+            )
+        return HDF5Settings(
+            ADCompression.BLOSC,
+            level=3,
+            blosc_compressor=BloscCompressor.ZSTD,
+            shuffle=shuffle,
+            frames_per_chunk=frames_per_chunk,
+        )
+
+
+class TSTVimbaDetector(VimbaDetector):
+    """A ``VimbaDetector`` that sets its HDF5 compression and chunking at prepare.
+
+    The settings come from ``hdf5_profile`` for the frame size read from the
+    driver and the frame rate of the ``TriggerInfo``, unless ``hdf5_settings``
+    pins them. ``last_hdf5_settings`` holds the ones used by the last prepare.
+    """
+
+    def __init__(self, prefix, path_provider, fileio_suffix="HDF1:", **kwargs):
+        self.hdf5 = HDF5CompressionIO(prefix + fileio_suffix)
+        self.hdf5_profile = HDF5WriterProfile()
+        self.hdf5_settings = None
+        self.last_hdf5_settings = None
+        super().__init__(prefix, path_provider, fileio_suffix=fileio_suffix, **kwargs)
+
+    @AsyncStatus.wrap
+    async def prepare(self, value: TriggerInfo) -> None:
+        # The connect step warms up the plugin; this catches an IOC restarted since.
+        if not device_registry.mock:
+            await warmup_hdf5_plugin(self)
+        settings = self.hdf5_settings
+        if settings is None:
+            rows, cols, data_type = await asyncio.gather(
+                self.driver.array_size_y.get_value(),
+                self.driver.array_size_x.get_value(),
+                self.driver.data_type.get_value(),
+            )
+            period = (value.livetime or 0) + (value.deadtime or 0)
+            settings = self.hdf5_profile.choose(
+                (rows, cols),
+                # Undefined before the first frame; the Mantas default to 8 bits.
+                data_type.value.lower() or "uint8",
+                1 / period if period else None,
+            )
+        await asyncio.gather(
+            self.fileio.compression.set(settings.compression),
+            self.hdf5.zlevel.set(settings.level),
+            self.hdf5.blosc_compressor.set(settings.blosc_compressor),
+            self.hdf5.blosc_level.set(settings.level),
+            self.hdf5.blosc_shuffle.set(settings.shuffle),
+            self.hdf5.num_frames_chunks.set(settings.frames_per_chunk),
         )
+        self.last_hdf5_settings = settings
+        await super().prepare(value)
+
 
-    print("Done")
-    return manta_async
+def instantiate_manta_async(manta_id):
+    print(f"Registering manta device {manta_id}")
+    manta_async = TSTVimbaDetector(
+        f"XF:31ID1-ES{{GigE-Cam:{manta_id}}}",
+        TSTPathProvider(RE.md),
+        name=f"manta{manta_id}",
+    )
+    return device_registry.add(manta_async)
 
 
 manta1 = instantiate_manta_async(1)
 manta2 = instantiate_manta_async(2)
 
-# warmup_hdf_plugins([manta1, manta2])
-
 
-file_loading_timer.stop_timer(__file__)
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,470 @@
+startup_profiler.start_file(__file__)
+
+import asyncio
+import math
+import threading
+from pathlib import Path
+
+import numpy as np
+from ophyd_async.epics.adcore import ADBaseDataType, AreaDetector
+from ophyd_async.epics.motor import Motor
+from ophyd_async.fastcs.panda import (
+    DatasetTable,
+    HDFPanda,
+    PandaHdf5DatasetType,
+    SeqTrigger,
+)
+
+if SIMULATE:
+    # ophyd_async.testing imports pytest, which only the dev environment has.
+    from ophyd_async.testing import callback_on_mock_put, set_mock_value
+
+h5py = lazy_import("h5py")
+
+
+def _trapezoid(distance, velocity, acceleration_time):
+    """Ramp time, cruise time and peak velocity of a move of ``distance``."""
+    if acceleration_time <= 0:
+        return 0.0, distance / velocity, velocity
+    if distance >= velocity * acceleration_time:
+        return acceleration_time, distance / velocity - acceleration_time, velocity
+    # Too short to reach full speed: accelerate half way, then decelerate.
+    ramp = math.sqrt(distance * acceleration_time / velocity)
+    return ramp, 0.0, velocity * ramp / acceleration_time
+
+
+class _Move:
+    """Position over time of a trapezoidal-profile move."""
+
+    def __init__(self, start_time, start, end, velocity, acceleration_time):
+        self.start_time = start_time
+        self.start = start
+        self.end = end
+        self.distance = abs(end - start)
+        self.direction = 1 if end >= start else -1
+        self.ramp, self.cruise, self.peak = _trapezoid(
+            self.distance, velocity, acceleration_time
+        )
+        self.duration = 2 * self.ramp + self.cruise
+
+    def position(self, t):
+        t = min(max(t - self.start_time, 0.0), self.duration)
+        accel = self.peak / self.ramp if self.ramp else 0.0
+        if t <= self.ramp:
+            travelled = accel * t**2 / 2
+        elif t <= self.ramp + self.cruise:
+            travelled = self.peak * self.ramp / 2 + self.peak * (t - self.ramp)
+        else:
+            remaining = self.duration - t
+            travelled = self.distance - accel * remaining**2 / 2
+        return self.start + self.direction * travelled
+
+
+class SimulatedMotor:
+    """Make a mocked ``Motor`` take as long to move as the real one.
+
+    Moves follow a trapezoidal velocity profile from the motor's velocity and
+    acceleration time signals; the readback is updated every ``update_period``
+    seconds and ``position`` gives the exact position at any time, e.g. for an
+    encoder.
+    """
+
+    def __init__(
+        self,
+        motor,
+        velocity=90.0,
+        max_velocity=180.0,
+        acceleration_time=0.5,
+        update_period=0.02,
+    ):
+        self.motor = motor
+        self.update_period = update_period
+        self._defaults = {
+            motor.motor_egu: "deg",
+            motor.velocity: velocity,
+            motor.max_velocity: max_velocity,
+            motor.acceleration_time: acceleration_time,
+            motor.precision: 3,
+            motor.low_limit_travel: -1e6,
+            motor.high_limit_travel: 1e6,
+            motor.motor_done_move: 1,
+        }
+        self._move = None
+        self._position = 0.0
+        self._stopped = False
+
+    def attach(self):
+        for signal, value in self._defaults.items():
+            set_mock_value(signal, value)
+        callback_on_mock_put(self.motor.user_setpoint, self._on_setpoint)
+        callback_on_mock_put(self.motor.motor_stop, self._on_stop)
+
+    def position(self, t=None):
+        if self._move is None:
+            return self._position
+        return self._move.position(
+            asyncio.get_running_loop().time() if t is None else t
+        )
+
+    async def _on_setpoint(self, value, wait):
+        loop = asyncio.get_running_loop()
+        velocity = abs(await self.motor.velocity.get_value())
+        acceleration_time = await self.motor.acceleration_time.get_value()
+        self._position = self.position()
+        self._move = _Move(
+            loop.time(), self._position, value, velocity, acceleration_time
+        )
+        self._stopped = False
+        set_mock_value(self.motor.motor_done_move, 0)
+        end_time = self._move.start_time + self._move.duration
+        while not self._stopped:
+            now = loop.time()
+            set_mock_value(self.motor.user_readback, self.position(now))
+            if now >= end_time:
+                break
+            await asyncio.sleep(min(self.update_period, end_time - now))
+        self._position = self.position()
+        self._move = None
+        set_mock_value(self.motor.user_readback, self._position)
+        set_mock_value(self.motor.motor_done_move, 1)
+
+    def _on_stop(self, value, wait):
+        self._stopped = True
+
+
+class _PcompState:
+    """Trigger positions of an enabled PCOMP block, in encoder counts."""
+
+    def __init__(self, start, step, pulses, direction):
+        self.start = start
+        self.step = step
+        # PCOMP without a step emits a single gate at its start position.
+        self.pulses = pulses if step > 0 else 1
+        self.direction = direction
+        self.fired = 0
+        self.primed = False
+
+    def advance(self, position):
+        """Positions of the pulses fired since the last call."""
+        # Like the hardware, wait until the encoder is before the start first.
+        if not self.primed:
+            self.primed = self.direction * (position - self.start) < 0
+            return []
+        fired = []
+        while self.pulses <= 0 or self.fired < self.pulses:
+            target = self.start + self.direction * self.fired * self.step
+            if self.direction * (position - target) < 0:
+                break
+            fired.append(target)
+            self.fired += 1
+        return fired
+
+
+class _SeqState:
+    """Rows of an enabled SEQ block, run through as the encoder passes them.
+
+    Only POSA comparisons are modelled: a row waiting for anything else fires at
+    once. A row with OUTA set in its first phase fires ``repeats`` pulses; the
+    phase times are not modelled, as the rows are much further apart than a tick.
+    """
+
+    COMPARISONS = {SeqTrigger.POSA_GT: 1, SeqTrigger.POSA_LT: -1}
+
+    def __init__(self, table):
+        self.rows = list(zip(table.trigger, table.position, table.repeats, table.outa1))
+        self.row = 0
+
+    @property
+    def done(self):
+        return self.row >= len(self.rows)
+
+    def advance(self, position):
+        """Positions of the pulses fired since the last call."""
+        fired = []
+        while not self.done:
+            trigger, target, repeats, outa1 = self.rows[self.row]
+            sign = self.COMPARISONS.get(SeqTrigger(trigger))
+            if sign is not None and sign * (position - target) < 0:
+                break
+            if outa1:
+                fired.extend([target if sign else position] * max(int(repeats), 1))
+            self.row += 1
+        return fired
+
+
+class SimulatedPanda:
+    """Make a mocked ``HDFPanda`` capture position-compare pulses to HDF5.
+
+    While PCAP is armed, every ``tick`` seconds the encoder position is taken
+    from the simulation's encoder motor and each enabled PCOMP block fires the
+    pulses it has passed, as does each enabled SEQ block for the rows of its
+    table (see ``_SeqState``). Each pulse appends a row (encoder counts and
+    timestamp) to the capture file, advances ``data.num_captured`` and triggers
+    the simulated cameras, as the PandA's TTL outputs would.
+    """
+
+    DATASETS = ("INENC1_VAL", "PCAP_TS_TRIG")
+
+    def __init__(self, panda, simulation, tick=0.001):
+        self.panda = panda
+        self.simulation = simulation
+        self.tick = tick
+        self.num_captured = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._task = None
+        self._blocks = {}
+
+    def attach(self):
+        data = self.panda.data
+        set_mock_value(data.directory_exists, True)
+        set_mock_value(
+            data.datasets,
+            DatasetTable(
+                name=list(self.DATASETS),
+                dtype=[PandaHdf5DatasetType.FLOAT_64] * len(self.DATASETS),
+            ),
+        )
+        callback_on_mock_put(data.capture, self._on_capture)
+        callback_on_mock_put(self.panda.pcap.arm, self._on_arm)
+        # As in the beamline's layout, PCOMP1 is enabled; plans may switch it off
+        # and on again.
+        set_mock_value(self.panda.pcomp[1].enable, "ONE")
+        for index, pcomp in self.panda.pcomp.items():
+            callback_on_mock_put(pcomp.enable, self._enable_callback("pcomp", index))
+        for index, seq in self.panda.seq.items():
+            callback_on_mock_put(seq.enable, self._enable_callback("seq", index))
+
+    def _enable_callback(self, kind, index):
+        async def _on_enable(value, wait):
+            await self._on_enable(kind, index, value)
+
+        return _on_enable
+
+    async def _on_capture(self, value, wait):
+        data = self.panda.data
+        if value:
+            directory = Path(await data.hdf_directory.get_value())
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / await data.hdf_file_name.get_value()
+            self._file = h5py.File(path, "w", libver="latest")
+            for name in self.DATASETS:
+                self._file.create_dataset(
+                    name, (0,), maxshape=(None,), chunks=(1024,), dtype="f8"
+                )
+            self._file.swmr_mode = True
+            self.num_captured = 0
+            set_mock_value(data.num_captured, 0)
+        elif self._file is not None:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+    async def _on_arm(self, value, wait):
+        if value:
+            self._blocks = {}
+            for kind in ("pcomp", "seq"):
+                for index, block in getattr(self.panda, kind).items():
+                    if await block.enable.get_value() != "ZERO":
+                        await self._on_enable(kind, index, "ONE")
+            self._start_time = asyncio.get_running_loop().time()
+            self._task = asyncio.create_task(self._capture())
+        elif self._task is not None:
+            self._task.cancel()
+            self._task = None
+        set_mock_value(self.panda.pcap.active, bool(value))
+
+    async def _on_enable(self, kind, index, value):
+        block = getattr(self.panda, kind)[index]
+        if value == "ZERO":
+            self._blocks.pop((kind, index), None)
+            if kind == "seq":
+                set_mock_value(block.active, False)
+            return
+        if kind == "seq":
+            self._blocks[kind, index] = _SeqState(await block.table.get_value())
+            set_mock_value(block.active, True)
+            return
+        start, step, pulses, direction = await asyncio.gather(
+            block.start.get_value(),
+            block.step.get_value(),
+            block.pulses.get_value(),
+            block.dir.get_value(),
+        )
+        self._blocks[kind, index] = _PcompState(
+            start, step, pulses, -1 if direction == "Negative" else 1
+        )
+
+    async def _capture(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.tick)
+            position = self.simulation.encoder_position()
+            fired = []
+            for (kind, index), state in list(self._blocks.items()):
+                fired.extend(state.advance(position))
+                if kind == "seq" and state.done:
+                    set_mock_value(self.panda.seq[index].active, False)
+            if not fired:
+                continue
+            for camera in self.simulation.cameras.values():
+                for _ in fired:
+                    camera.trigger()
+            timestamp = loop.time() - self._start_time
+            if self._file is not None:
+                rows = {
+                    "INENC1_VAL": np.asarray(fired, dtype="f8"),
+                    "PCAP_TS_TRIG": np.full(len(fired), timestamp),
+                }
+                await asyncio.to_thread(self._write, rows)
+            self.num_captured += len(fired)
+            set_mock_value(self.panda.data.num_captured, self.num_captured)
+
+    def _write(self, rows):
+        with self._lock:
+            if self._file is None:
+                return
+            for name, values in rows.items():
+                dataset = self._file[name]
+                dataset.resize((dataset.shape[0] + len(values),))
+                dataset[-len(values) :] = values
+                dataset.flush()
+
+
+class SimulatedCamera:
+    """Make a mocked area detector write a frame to HDF5 for each trigger.
+
+    While acquiring, ``trigger`` (called by the simulated PandA) queues a frame;
+    frames are written one at a time, each no earlier than the exposure time
+    after its trigger, so the capture rate is limited by the exposure and by how
+    fast HDF5 frames of ``shape`` can be written.
+    """
+
+    def __init__(self, detector, shape=(1216, 1936), data_type=ADBaseDataType.UINT8):
+        self.detector = detector
+        self.shape = shape
+        self.data_type = data_type
+        self.num_captured = 0
+        self._acquiring = False
+        self._file = None
+        self._frames = None
+        self._task = None
+        dtype = np.dtype(data_type.value.lower())
+        rng = np.random.default_rng(0)
+        self._frame = rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+
+    def attach(self):
+        driver, fileio = self.detector.driver, self.detector.fileio
+        set_mock_value(driver.array_size_y, self.shape[0])
+        set_mock_value(driver.array_size_x, self.shape[1])
+        set_mock_value(driver.data_type, self.data_type)
+        set_mock_value(fileio.array_size_y, self.shape[0])
+        set_mock_value(fileio.array_size_x, self.shape[1])
+        set_mock_value(fileio.data_type, self.data_type)
+        set_mock_value(fileio.file_path_exists, True)
+        set_mock_value(fileio.num_frames_chunks, 1)
+        callback_on_mock_put(driver.acquire, self._on_acquire)
+        callback_on_mock_put(fileio.capture, self._on_capture)
+        if hasattr(self.detector, "hdf5"):
+            # Chunking chosen at prepare shows up on the readback the writer uses.
+            callback_on_mock_put(
+                self.detector.hdf5.num_frames_chunks,
+                lambda value, wait: set_mock_value(fileio.num_frames_chunks, value),
+            )
+
+    def trigger(self):
+        if self._acquiring and self._frames is not None:
+            self._frames.put_nowait(asyncio.get_running_loop().time())
+
+    def _on_acquire(self, value, wait):
+        self._acquiring = bool(value)
+
+    async def _on_capture(self, value, wait):
+        fileio = self.detector.fileio
+        if value:
+            directory = Path(await fileio.file_path.get_value())
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{await fileio.file_name.get_value()}.h5"
+            self._file = h5py.File(path, "w", libver="latest")
+            self._file.create_dataset(
+                "entry/data/data",
+                (0, *self.shape),
+                maxshape=(None, *self.shape),
+                chunks=(await fileio.num_frames_chunks.get_value(), *self.shape),
+                dtype=self._frame.dtype,
+            )
+            self._file.swmr_mode = True
+            self.num_captured = 0
+            set_mock_value(fileio.full_file_name, str(path))
+            set_mock_value(fileio.num_captured, 0)
+            self._frames = asyncio.Queue()
+            self._task = asyncio.create_task(self._write_frames())
+        elif self._file is not None:
+            # Let the frames already triggered be written, as the IOC would.
+            self._frames.put_nowait(None)
+            await self._task
+            self._file.close()
+            self._file = self._frames = self._task = None
+
+    async def _write_frames(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            triggered = await self._frames.get()
+            if triggered is None:
+                return
+            exposure = await self.detector.driver.acquire_time.get_value()
+            await asyncio.sleep(max(triggered + exposure - loop.time(), 0))
+            await asyncio.to_thread(self._write)
+            self.num_captured += 1
+            set_mock_value(self.detector.fileio.num_captured, self.num_captured)
+            set_mock_value(self.detector.driver.array_counter, self.num_captured)
+
+    def _write(self):
+        dataset = self._file["entry/data/data"]
+        dataset.resize((dataset.shape[0] + 1, *self.shape))
+        dataset[-1] = self._frame
+        dataset.flush()
+
+
+class Simulation:
+    """Simulated hardware behind the profile's mocked devices.
+
+    ``attach``, registered as a ``device_registry`` connect callback, pairs each
+    connected ``Motor``, ``HDFPanda`` and area detector with its simulation. The
+    PandAs read their encoder from ``encoder_motor`` and trigger every camera.
+    """
+
+    def __init__(self, encoder_motor="rot_motor", counts_per_deg=None):
+        self.encoder_motor = encoder_motor
+        self.counts_per_deg = counts_per_deg
+        self.motors = {}
+        self.pandas = {}
+        self.cameras = {}
+
+    def attach(self, device):
+        if isinstance(device, Motor):
+            self.motors[device.name] = SimulatedMotor(device)
+            self.motors[device.name].attach()
+        elif isinstance(device, HDFPanda):
+            self.pandas[device.name] = SimulatedPanda(device, self)
+            self.pandas[device.name].attach()
+        elif isinstance(device, AreaDetector):
+            self.cameras[device.name] = SimulatedCamera(device)
+            self.cameras[device.name].attach()
+
+    def encoder_position(self):
+        motor = self.motors.get(self.encoder_motor)
+        if motor is None:
+            return 0
+        return motor.position() * (self.counts_per_deg or COUNTS_PER_DEG)
+
+
+if SIMULATE:
+    print(f"Simulating the hardware, data is written to {SIMULATION_DATA_DIR}")
+    RE.md.setdefault("data_session", "pass-000000")
+    RE.md.setdefault("cycle", "2000-1")
+    simulation = Simulation()
+    device_registry.add_connect_callback(simulation.attach)
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,88 @@
+startup_profiler.start_file(__file__)
+
+from ophyd_async.core import DEFAULT_TIMEOUT
+from ophyd_async.epics.adcore import ADCallbacks, ADImageMode, AreaDetector
+from ophyd_async.epics.advimba import VimbaDriverIO, VimbaOnOff
+
+
+async def warmup_hdf5_plugin(detector, exposure_time=0.01):
+    """Acquire one frame if the detector's HDF5 plugin has not seen one yet.
+
+    After an IOC restart the plugin's array size is 0 until a frame arrives,
+    and opening a file before then fails. The frame is taken with the driver
+    free running in single image mode; the driver settings are restored after.
+
+    Parameters
+    ----------
+    detector : AreaDetector
+    exposure_time : float, optional
+        Exposure of the warm-up frame, in seconds.
+
+    Returns
+    -------
+    bool
+        Whether a warm-up frame was needed.
+    """
+    driver, fileio = detector.driver, detector.fileio
+    if all(
+        await asyncio.gather(
+            fileio.array_size_x.get_value(), fileio.array_size_y.get_value()
+        )
+    ):
+        return False
+
+    print(f"Warming up the HDF5 plugin of {detector.name}...")
+    settings = {
+        driver.image_mode: ADImageMode.SINGLE,
+        driver.num_images: 1,
+        driver.acquire_time: exposure_time,
+        fileio.enable_callbacks: ADCallbacks.ENABLE,
+    }
+    if isinstance(driver, VimbaDriverIO):
+        settings[driver.trigger_mode] = VimbaOnOff.OFF
+    saved = dict(
+        zip(
+            settings,
+            await asyncio.gather(*(signal.get_value() for signal in settings)),
+        )
+    )
+    await asyncio.gather(*(signal.set(value) for signal, value in settings.items()))
+    try:
+        await driver.acquire.set(True, timeout=exposure_time + DEFAULT_TIMEOUT)
+    finally:
+        await asyncio.gather(*(signal.set(value) for signal, value in saved.items()))
+
+    size = await asyncio.gather(
+        fileio.array_size_y.get_value(), fileio.array_size_x.get_value()
+    )
+    print(f"Warmed up the HDF5 plugin of {detector.name}: array size {size}.")
+    return True
+
+
+async def warmup_hdf5_plugins(detectors):
+    """Warm up the HDF5 plugins of ``detectors`` concurrently.
+
+    Returns the names of the detectors that needed a warm-up frame.
+    """
+    detectors = [det for det in detectors if isinstance(det, AreaDetector)]
+    needed = await asyncio.gather(*(warmup_hdf5_plugin(det) for det in detectors))
+    return [det.name for det, warmed in zip(detectors, needed) if warmed]
+
+
+async def _warmup_on_connect(device):
+    if isinstance(device, AreaDetector):
+        await warmup_hdf5_plugin(device)
+
+
+# Devices connect concurrently, so their warm-ups do too; a device reconnected by
+# ``lazy_connect`` after an IOC restart is warmed up before the plan uses it.
+if not device_registry.mock:
+    device_registry.add_connect_callback(_warmup_on_connect)
+
+# Connect everything registered by the files above in a single pass. Devices that
+# could not be connected now are connected by the RunEngine on first use.
+device_registry.connect_all()
+RE.preprocessors.append(device_registry.lazy_connect)
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,152 @@
+startup_profiler.start_file(__file__)
+
+import threading
+import time as ttime
+from pathlib import Path
+
+import numpy as np
+
+h5py = lazy_import("h5py")
+
+
+class _RingBuffer:
+    """The most recent ``max_rows`` rows of a 1-D stream, in a fixed allocation."""
+
+    def __init__(self, max_rows, dtype):
+        self._data = np.empty(max_rows, dtype=dtype)
+        self._rows = 0
+
+    def append(self, chunk):
+        chunk = chunk[-len(self._data) :]
+        start = self._rows % len(self._data)
+        first = min(len(chunk), len(self._data) - start)
+        self._data[start : start + first] = chunk[:first]
+        self._data[: len(chunk) - first] = chunk[first:]
+        self._rows += len(chunk)
+
+    def view(self):
+        if self._rows <= len(self._data):
+            return self._data[: self._rows].copy()
+        start = self._rows % len(self._data)
+        return np.concatenate([self._data[start:], self._data[:start]])
+
+
+class PandaLiveReader:
+    """Follow a PandA HDF5 file while it is written and publish the new rows.
+
+    A background thread opens the file in SWMR mode, refreshes its datasets every
+    ``poll_period`` seconds and reads only the rows added since the last poll. Each
+    batch is passed to every consumer as ``{dataset_name: ndarray}`` (all arrays with
+    the same number of rows), e.g. to update a live plot or a reducer, and kept in a
+    per-dataset ring buffer of at most ``max_rows`` rows, available from ``latest``.
+    A ``transform`` given to ``start`` maps each batch before then, e.g. a
+    ``CalibrationTransform`` adding the positions in degrees.
+    """
+
+    def __init__(self, consumers=(), poll_period=0.25, max_rows=100_000):
+        self.consumers = list(consumers)
+        self.poll_period = poll_period
+        self.max_rows = max_rows
+        self.rows_read = 0
+        self._buffers = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._transform = None
+
+    def start(self, path, open_timeout=10, transform=None):
+        """Start following the file at ``path``, waiting for it to be created."""
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError("The reader is already following a file.")
+        self.rows_read = 0
+        self._transform = transform
+        self._buffers = {}
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(Path(path), open_timeout),
+            name="panda-live-reader",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Read the remaining rows and close the file."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def latest(self):
+        return {name: buffer.view() for name, buffer in self._buffers.items()}
+
+    def _run(self, path, open_timeout):
+        deadline = ttime.monotonic() + open_timeout
+        while True:
+            try:
+                f = h5py.File(path, "r", libver="latest", swmr=True)
+                break
+            except OSError:
+                if self._stop.is_set() or ttime.monotonic() > deadline:
+                    print(f"Could not open {path} for live reading.")
+                    return
+                ttime.sleep(self.poll_period)
+
+        with f:
+            datasets = {}
+
+            def collect(name, obj):
+                if isinstance(obj, h5py.Dataset) and obj.ndim == 1:
+                    datasets[name] = obj
+
+            f.visititems(collect)
+            while not self._stop.wait(self.poll_period):
+                if not datasets:
+                    f.visititems(collect)
+                self._poll(datasets)
+            self._poll(datasets)
+
+    def _poll(self, datasets):
+        for dataset in datasets.values():
+            dataset.refresh()
+        # Datasets are flushed together, but only publish rows present in all of them.
+        available = min((dataset.shape[0] for dataset in datasets.values()), default=0)
+        if available <= self.rows_read:
+            return
+
+        chunk = {
+            name: dataset[self.rows_read : available]
+            for name, dataset in datasets.items()
+        }
+        self.rows_read = available
+        if self._transform is not None:
+            chunk = self._transform(chunk)
+        for name, values in chunk.items():
+            if name not in self._buffers:
+                self._buffers[name] = _RingBuffer(self.max_rows, values.dtype)
+            self._buffers[name].append(values)
+        for consumer in self.consumers:
+            try:
+                consumer(chunk)
+            except Exception as ex:
+                print(f"Live data consumer {consumer!r} failed: {ex!r}")
+
+
+def start_panda_live_reader(panda, reader, calibrations=None):
+    """Point ``reader`` at the file ``panda`` writes; call after ``prepare``.
+
+    With ``calibrations`` (from ``read_panda_calibration``) the reader adds the
+    calibrated positions to every batch.
+    """
+    directory = yield from bps.rd(panda.data.hdf_directory)
+    file_name = yield from bps.rd(panda.data.hdf_file_name)
+    transform = CalibrationTransform(calibrations.values()) if calibrations else None
+    reader.start(Path(directory) / file_name, transform=transform)
+
+
+def stop_panda_live_reader(reader):
+    """Stop ``reader`` (if any), e.g. as the final plan of ``bpp.finalize_wrapper``."""
+    if reader is not None:
+        reader.stop()
+    yield from bps.null()
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,151 @@
+startup_profiler.start_file(__file__)
+
+import asyncio
+
+import bluesky.plan_stubs as bps
+import networkx as nx
+from bluesky.utils import short_uid
+
+
+def _num_captured(device):
+    """The signal counting the frames ``device`` has written, if it has one."""
+    # Area detectors count in their file writer, the PandA in its data block.
+    for block in ("fileio", "data"):
+        signal = getattr(getattr(device, block, None), "num_captured", None)
+        if signal is not None:
+            return signal
+    return None
+
+
+class _ProgressWatcher:
+    """Wake a waiting plan when a status finishes or a progress signal changes."""
+
+    def __init__(self, statuses, signals):
+        self.statuses = statuses
+        self.signals = signals
+        self._event = None
+        self._loop = None
+
+    async def start(self):
+        self._event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        for status in self.statuses:
+            status.add_callback(self._wake)
+        for signal in self.signals:
+            signal.subscribe_value(self._wake)
+
+    async def wait(self, timeout=None):
+        await asyncio.wait_for(self._event.wait(), timeout)
+        self._event.clear()
+
+    async def stop(self):
+        for signal in self.signals:
+            signal.clear_sub(self._wake)
+
+    def _wake(self, *_):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+
+def collect_while_completing_flyers(
+    flyers, detectors, stream_name=None, declare=True, stall_timeout=None
+):
+    """Complete ``flyers`` and collect ``detectors`` each time they capture frames.
+
+    Instead of polling, the plan sleeps until a detector's ``num_captured`` changes
+    or a flyer reports completion, collects the new frames and returns as soon as
+    every flyer is complete (after one last collect).
+
+    Parameters
+    ----------
+    stream_name : str, optional
+        Collect all detectors into this stream; by default each detector goes
+        into its own ``<name>_stream``.
+    declare : bool
+        Declare the streams first; pass False if the plan already declared them.
+    stall_timeout : float, optional
+        Raise ``TimeoutError`` if nothing happens for this many seconds.
+    """
+    if stream_name is not None:
+        streams = {stream_name: list(detectors)}
+    else:
+        streams = {f"{det.name}_stream": [det] for det in detectors}
+    if declare:
+        for name, stream_detectors in streams.items():
+            yield from bps.declare_stream(*stream_detectors, name=name)
+
+    group = short_uid("complete")
+    statuses = []
+    for flyer in flyers:
+        status = yield from bps.complete(flyer, group=group, wait=False)
+        statuses.append(status)
+    signals = [_num_captured(det) for det in detectors]
+    watcher = _ProgressWatcher(statuses, [sig for sig in signals if sig is not None])
+
+    yield from call_async(watcher.start)
+    try:
+        while True:
+            done = all(status.done for status in statuses)
+            for name, stream_detectors in streams.items():
+                yield from bps.collect(*stream_detectors, name=name)
+            if done:
+                break
+            yield from call_async(watcher.wait, stall_timeout)
+    finally:
+        yield from call_async(watcher.stop)
+    # Raise in the plan if any flyer failed to complete.
+    yield from bps.wait(group=group)
+
+
+class SetupGraph:
+    """Scan setup steps ordered by their dependencies and run as concurrently as possible.
+
+    Each step is a plan stub (``bps.abs_set``, ``bps.prepare``, ``bps.kickoff``,
+    ...) added with the steps it must follow. ``run`` issues the steps one
+    topological generation at a time, each in its own group and without waiting,
+    and before a generation only waits for the groups its steps depend on. So a
+    slow motor move holds back only the steps declared after it.
+
+        setup = SetupGraph()
+        setup.add("fast", bps.abs_set, motor.velocity, 90)
+        setup.add("to_start", bps.abs_set, motor, 0, after=["fast"])
+        setup.add("stage", bps.stage, detector, wait=False)
+        setup.add("prepare", bps.prepare, detector, info, after=["stage"])
+        yield from setup.run()
+    """
+
+    def __init__(self):
+        self.graph = nx.DiGraph()
+
+    def add(self, name, plan_stub, *args, after=(), **kwargs):
+        if name in self.graph:
+            raise ValueError(f"A setup step named {name!r} already exists.")
+        self.graph.add_node(name, step=(plan_stub, args, kwargs))
+        for dependency in after:
+            if dependency not in self.graph:
+                raise ValueError(f"Setup step {name!r} follows unknown {dependency!r}.")
+            self.graph.add_edge(dependency, name)
+        return name
+
+    def run(self):
+        """Plan issuing every step, returning once all of them have finished."""
+        groups = {}
+        pending = set()
+        for generation in nx.topological_generations(self.graph):
+            dependencies = {
+                dependency
+                for name in generation
+                for dependency in self.graph.predecessors(name)
+            }
+            for dependency in sorted(dependencies & pending):
+                yield from bps.wait(group=groups[dependency])
+                pending.discard(dependency)
+            for name in generation:
+                plan_stub, args, kwargs = self.graph.nodes[name]["step"]
+                groups[name] = short_uid(name)
+                pending.add(name)
+                yield from plan_stub(*args, group=groups[name], **kwargs)
+        for name in sorted(pending):
+            yield from bps.wait(group=groups[name])
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,168 @@
+startup_profiler.start_file(__file__)
+
+import functools
+import json
+import os
+import tempfile
+import time as ttime
+from collections import OrderedDict
+from pathlib import Path
+
+
+class PlanTimer:
+    """Time every device operation of a plan with ``time.perf_counter``.
+
+    ``wrap`` (or the ``timed`` decorator) passes the plan's messages through and
+    records, for each set, stage, unstage, prepare, kickoff, complete, collect
+    and wait message, the device and group it was sent with, when it was issued
+    (relative to the start of the plan), how long the RunEngine took to hand it
+    back and, for operations returning a status, how long until the status
+    finished. A ``wait`` is tagged with the devices of the operations in its
+    group, so the time a plan spends blocked can be attributed to the slowest
+    device.
+
+    Records are kept per run uid (the last ``max_runs`` runs), so plans wrapped
+    inside other wrapped plans, or running alongside them, do not overwrite each
+    other's; a message passing through several wraps is recorded once, by the
+    innermost. When a run closes, its records are appended as one JSON line to
+    ``TST_PLAN_TIMINGS_FILE`` (``<tmp>/tst-plan-timings.jsonl`` by default), to be
+    compared across runs, and the slowest operations are printed.
+    """
+
+    COMMANDS = {
+        "set",
+        "stage",
+        "unstage",
+        "prepare",
+        "kickoff",
+        "complete",
+        "collect",
+        "wait",
+    }
+
+    def __init__(self, path=None, report_slowest=5, max_runs=20):
+        self.path = Path(
+            path
+            or os.environ.get("TST_PLAN_TIMINGS_FILE")
+            or Path(tempfile.gettempdir()) / "tst-plan-timings.jsonl"
+        )
+        self.report_slowest = report_slowest
+        self.max_runs = max_runs
+        self.runs = OrderedDict()
+        self.last_run_uid = None
+        # Messages currently passing through a wrap, by id.
+        self._in_flight = set()
+
+    def timed(self, plan_function):
+        """Decorator timing every plan ``plan_function`` returns."""
+
+        @functools.wraps(plan_function)
+        def wrapper(*args, **kwargs):
+            return (yield from self.wrap(plan_function(*args, **kwargs)))
+
+        return wrapper
+
+    def wrap(self, plan):
+        # Until the plan opens a run its records are its own.
+        state = {"records": [], "group_devices": {}, "start": ttime.perf_counter()}
+        response, error = None, None
+        try:
+            while True:
+                try:
+                    msg = (
+                        plan.throw(error) if error is not None else plan.send(response)
+                    )
+                except StopIteration as stop:
+                    return stop.value
+                response, error = None, None
+                owned = id(msg) not in self._in_flight
+                self._in_flight.add(id(msg))
+                if msg.command == "close_run" and owned:
+                    self._write(getattr(plan, "__name__", "plan"), state)
+                issued = ttime.perf_counter()
+                try:
+                    response = yield msg
+                except GeneratorExit:
+                    raise
+                except BaseException as ex:
+                    error = ex
+                finally:
+                    if owned:
+                        self._in_flight.discard(id(msg))
+                if msg.command == "open_run" and error is None:
+                    self._open(response, state)
+                if owned:
+                    self._record(msg, issued, response, state)
+        finally:
+            plan.close()
+
+    def summary(self, run_uid=None):
+        """Total seconds per (command, device) of a run (the last one by default)."""
+        return self._totals(self.runs.get(run_uid or self.last_run_uid, []))
+
+    @staticmethod
+    def _totals(records):
+        totals = {}
+        for record in records:
+            key = (record["command"], record["device"])
+            totals[key] = totals.get(key, 0) + (record["done"] or record["returned"])
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def _open(self, run_uid, state):
+        records = self.runs.setdefault(run_uid, [])
+        if "run_uid" not in state:
+            records.extend(state["records"])
+        state["records"] = records
+        state["run_uid"] = run_uid
+        self.last_run_uid = run_uid
+        while len(self.runs) > self.max_runs:
+            self.runs.popitem(last=False)
+
+    def _record(self, msg, issued, response, state):
+        if msg.command not in self.COMMANDS:
+            return
+        group = msg.kwargs.get("group")
+        group_devices = state["group_devices"]
+        if msg.command == "wait":
+            device = ",".join(sorted(group_devices.get(group, ())))
+        else:
+            device = getattr(msg.obj, "name", None)
+            if group is not None and device:
+                group_devices.setdefault(group, set()).add(device)
+        record = {
+            "command": msg.command,
+            "device": device,
+            "group": group,
+            "issued": issued - state["start"],
+            "returned": ttime.perf_counter() - issued,
+            "done": None,
+        }
+        state["records"].append(record)
+        if hasattr(response, "add_callback"):
+
+            def _done(status):
+                record["done"] = ttime.perf_counter() - issued
+
+            response.add_callback(_done)
+
+    def _write(self, plan_name, state):
+        entry = {
+            "run_uid": state.get("run_uid"),
+            "plan": plan_name,
+            "time": now(),
+            "records": state["records"],
+        }
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+        except OSError as ex:
+            print(f"Could not write the plan timings to {self.path}: {ex}")
+        slowest = list(self._totals(entry["records"]).items())[: self.report_slowest]
+        for (command, device), seconds in slowest:
+            print(f"  {seconds:8.3f} s  {command:<8} {device}")
+
+
+plan_timer = PlanTimer()
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,170 @@
+startup_profiler.start_file(__file__)
+
+import dataclasses
+import math
+from dataclasses import dataclass
+
+import numpy as np
+from ophyd_async.epics.motor import FlyMotorInfo
+
+# Number of encoder counts for an entire revolution
+COUNTS_PER_REVOLUTION = 8000
+DEG_PER_REVOLUTION = 360
+COUNTS_PER_DEG = COUNTS_PER_REVOLUTION / DEG_PER_REVOLUTION
+
+
+@dataclass(frozen=True)
+class TomoTrajectory:
+    """Everything a rotation fly scan needs, worked out before the scan starts.
+
+    Encoder quantities are integer counts as the PandA PCOMP block uses them;
+    ``timestamps`` are seconds after the motor's kickoff.
+    """
+
+    num_images: int
+    step_counts: int
+    gate_counts: int
+    exposure_time: float
+    velocity: float
+    scan_time: float
+    run_up_deg: float
+    counts_per_deg: float
+    positions_counts: np.ndarray
+    gate_widths_counts: np.ndarray
+    timestamps: np.ndarray
+
+    @property
+    def positions_deg(self):
+        return self.positions_counts / self.counts_per_deg
+
+    @property
+    def start_deg(self):
+        return float(self.positions_deg[0])
+
+    @property
+    def end_deg(self):
+        return float(self.positions_deg[-1])
+
+    @property
+    def direction(self):
+        """1 if the positions increase, -1 if the sweep runs backwards."""
+        return 1 if self.positions_counts[-1] >= self.positions_counts[0] else -1
+
+    @property
+    def fly_info(self):
+        """Constant-velocity motor move covering every frame plus the run-up margin.
+
+        The motor adds its own acceleration distance on top of this in ``prepare``.
+        """
+        start = self.start_deg - self.direction * self.run_up_deg
+        end = self.end_deg + self.direction * self.run_up_deg
+        return FlyMotorInfo(
+            start_position=start,
+            end_position=end,
+            time_for_move=abs(end - start) / self.velocity,
+        )
+
+    def reversed(self):
+        """The same sweep travelled from its last frame back to its first."""
+        return dataclasses.replace(
+            self,
+            positions_counts=self.positions_counts[::-1].copy(),
+            gate_widths_counts=self.gate_widths_counts[::-1].copy(),
+        )
+
+
+def plan_tomo_trajectory(
+    num_images,
+    scan_time,
+    start_deg=0,
+    exposure_time=None,
+    span_deg=DEG_PER_REVOLUTION / 2,
+    deadtime=0.001,
+    max_velocity=None,
+    acceleration_time=0.0,
+    settle_time=0.25,
+    counts_per_deg=COUNTS_PER_DEG,
+):
+    """Compute the per-frame trigger positions, gate widths and times of a scan.
+
+    Instead of rejecting a request that does not map onto whole encoder counts, the
+    nearest feasible configuration is chosen and reported: the step between frames
+    is rounded to an integer number of counts (which adjusts the span slightly),
+    the velocity is capped at ``max_velocity`` (which lengthens the scan) and the
+    exposure is shortened to fit between two triggers.
+
+    Parameters
+    ----------
+    num_images : int
+        Number of frames, the first at ``start_deg`` and the last ``span_deg`` later.
+    scan_time : float
+        Requested time between the first and last frame, in seconds.
+    exposure_time : float, optional
+        Gate width in seconds, a third of the frame period by default.
+    max_velocity, acceleration_time : float, optional
+        Motor limits in deg/s and s; 0 or None means unknown.
+    settle_time : float
+        Time at constant velocity before the first and after the last frame.
+    """
+    if num_images < 2:
+        raise ValueError("A trajectory needs at least two frames.")
+
+    ideal_step = span_deg * counts_per_deg / (num_images - 1)
+    step_counts = max(int(round(ideal_step)), 1)
+    if not math.isclose(step_counts, ideal_step, rel_tol=1e-6):
+        print(
+            f"Using {step_counts} encoder counts per frame instead of {ideal_step:.3f}, "
+            f"the scan covers {step_counts * (num_images - 1) / counts_per_deg:.4f} deg."
+        )
+    span_counts = step_counts * (num_images - 1)
+
+    velocity = span_counts / counts_per_deg / scan_time
+    if max_velocity and velocity > max_velocity:
+        velocity = max_velocity
+        scan_time = span_counts / counts_per_deg / velocity
+        print(f"Capped at the motor's {velocity} deg/s, the scan takes {scan_time} s.")
+
+    counts_per_second = velocity * counts_per_deg
+    step_time = step_counts / counts_per_second
+    if exposure_time is None:
+        exposure_time = step_time / 3
+    max_gate_counts = step_counts - math.ceil(deadtime * counts_per_second)
+    gate_counts = math.ceil(exposure_time * counts_per_second)
+    if gate_counts > max_gate_counts:
+        gate_counts = max(max_gate_counts, 1)
+        exposure_time = gate_counts / counts_per_second
+        print(f"Exposure shortened to {exposure_time:.6f} s to fit between frames.")
+
+    run_up_deg = velocity * settle_time
+    frames = np.arange(num_images)
+    positions_counts = int(round(start_deg * counts_per_deg)) + step_counts * frames
+    timestamps = (acceleration_time or 0.0) + settle_time + frames * step_time
+
+    return TomoTrajectory(
+        num_images=num_images,
+        step_counts=step_counts,
+        gate_counts=gate_counts,
+        exposure_time=exposure_time,
+        velocity=velocity,
+        scan_time=scan_time,
+        run_up_deg=run_up_deg,
+        counts_per_deg=counts_per_deg,
+        positions_counts=positions_counts,
+        gate_widths_counts=np.full(num_images, gate_counts),
+        timestamps=timestamps,
+    )
+
+
+def plan_tomo_sweeps(num_sweeps, *args, bidirectional=True, **kwargs):
+    """Trajectories of ``num_sweeps`` consecutive sweeps over the same range.
+
+    Takes the arguments of ``plan_tomo_trajectory``. With ``bidirectional`` every
+    other sweep runs backwards, so the motor turns around at the end of a sweep
+    instead of travelling back to the start.
+    """
+    forward = plan_tomo_trajectory(*args, **kwargs)
+    backward = forward.reversed() if bidirectional else forward
+    return [forward if i % 2 == 0 else backward for i in range(num_sweeps)]
+
+
+startup_profiler.stop_file(__file__)
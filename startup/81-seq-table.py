@@ -0,0 +1,173 @@
+startup_profiler.start_file(__file__)
+
+import bluesky.preprocessors as bpp
+import numpy as np
+from ophyd_async.core import DetectorTrigger, TriggerInfo
+from ophyd_async.epics.motor import FlyMotorInfo
+from ophyd_async.fastcs.panda import SeqTable, SeqTrigger
+
+# Rows a PandA SEQ block can hold.
+SEQ_TABLE_MAX_ROWS = 4096
+
+# Energy (eV) of a photoelectron with wavenumber k (1/Angstrom): E = E0 + k^2 * this.
+HBAR2_OVER_2M = 3.80998212
+
+
+def kspace_energies(e0, k_start, k_end, k_step):
+    """Energies of points evenly spaced in photoelectron wavenumber above ``e0``."""
+    k = np.arange(k_start, k_end + k_step / 2, k_step)
+    return e0 + HBAR2_OVER_2M * k**2
+
+
+def build_seq_table(positions, exposure_time, counts_per_deg=COUNTS_PER_DEG):
+    """Build a SEQ table emitting one gate on OUTA per position, in one vectorized pass.
+
+    Each row waits until the encoder (POSA) passes the row's position, holds OUTA
+    high for the exposure time and then low for one tick. Times are in microseconds,
+    the table expects the block's prescaler to be set to 1 us.
+
+    Parameters
+    ----------
+    positions : array_like
+        Strictly monotonic motor positions in degrees.
+    exposure_time : float or array_like
+        Gate width in seconds, per point or for all points.
+    """
+    positions = np.asarray(positions, dtype=float)
+    n = len(positions)
+    if n > SEQ_TABLE_MAX_ROWS:
+        raise ValueError(f"{n} points do not fit in a {SEQ_TABLE_MAX_ROWS} row table.")
+    steps = np.diff(positions)
+    if not (np.all(steps > 0) or np.all(steps < 0)):
+        raise ValueError("Positions must be strictly monotonic.")
+    trigger = SeqTrigger.POSA_GT if n < 2 or steps[0] > 0 else SeqTrigger.POSA_LT
+
+    gate_us = np.broadcast_to(np.rint(np.asarray(exposure_time) * 1e6), (n,))
+    low = np.zeros(n, dtype=np.bool_)
+    return SeqTable(
+        repeats=np.ones(n, dtype=np.uint16),
+        trigger=[trigger] * n,
+        position=np.rint(positions * counts_per_deg).astype(np.int32),
+        time1=gate_us.astype(np.uint32),
+        outa1=np.ones(n, dtype=np.bool_),
+        outb1=low,
+        outc1=low,
+        outd1=low,
+        oute1=low,
+        outf1=low,
+        time2=np.ones(n, dtype=np.uint32),
+        outa2=low,
+        outb2=low,
+        outc2=low,
+        outd2=low,
+        oute2=low,
+        outf2=low,
+    )
+
+
+@plan_timer.timed
+def xas_seq_fly_async(
+    panda,
+    positions,
+    exposure_time,
+    total_time,
+    detectors=(),
+    seq_index=1,
+    deadtime=0.001,
+    settle_time=0.25,
+):
+    """Hardware-timed fly scan over arbitrary (e.g. k-space) points.
+
+    The points are loaded into the PandA's SEQ block as a table, which gates the
+    detectors (through OUTA, as wired in the PandA layout) when the encoder passes
+    each point, so the whole scan is a single constant-velocity motor pass. The
+    PCOMP blocks are switched off meanwhile, so that only the table triggers, and
+    switched back on after.
+
+    Parameters
+    ----------
+    positions : array_like
+        Strictly monotonic motor positions in degrees, e.g. from ``kspace_energies``
+        mapped onto the motor.
+    exposure_time : float or array_like
+        Gate width in seconds, per point or for all points.
+    total_time : float
+        Time between the first and the last point.
+    """
+    positions = np.asarray(positions, dtype=float)
+    table = build_seq_table(positions, exposure_time)
+    seq = panda.seq[seq_index]
+
+    span = positions[-1] - positions[0]
+    velocity = abs(span) / total_time
+    shortest = np.min(np.abs(np.diff(positions))) / velocity
+    if shortest < np.max(exposure_time) + deadtime:
+        raise ValueError(
+            f"The closest points are {shortest:.4f} s apart, too close for "
+            f"{np.max(exposure_time)} s exposures at {velocity:.3f} deg/s."
+        )
+    run_up = np.sign(span) * velocity * settle_time
+    fly_info = FlyMotorInfo(
+        start_position=positions[0] - run_up,
+        end_position=positions[-1] + run_up,
+        time_for_move=total_time + 2 * settle_time,
+    )
+    trigger_info = TriggerInfo(
+        number_of_events=len(positions),
+        livetime=float(np.max(exposure_time)),
+        deadtime=deadtime,
+        trigger=DetectorTrigger.CONSTANT_GATE,
+    )
+    detector_trigger_info = TriggerInfo(
+        number_of_events=len(positions),
+        livetime=float(np.max(exposure_time)),
+        deadtime=deadtime,
+        trigger=DetectorTrigger.EDGE_TRIGGER,
+    )
+    all_detectors = [*detectors, panda]
+    all_devices = [*all_detectors, rot_motor]
+
+    pcomp_enables = {}
+    for pcomp in panda.pcomp.values():
+        pcomp_enables[pcomp] = yield from bps.rd(pcomp.enable)
+
+    def scan():
+        # Load the table while the motor runs to its start position.
+        yield from bps.abs_set(seq.enable, "ZERO", group="seq_setup")
+        for pcomp in pcomp_enables:
+            yield from bps.abs_set(pcomp.enable, "ZERO", group="seq_setup")
+        yield from bps.abs_set(seq.prescale_units, "us", group="seq_setup")
+        yield from bps.abs_set(seq.prescale, 1, group="seq_setup")
+        yield from bps.abs_set(seq.repeats, 1, group="seq_setup")
+        yield from bps.abs_set(seq.table, table, group="seq_setup")
+
+        yield from bps.open_run(
+            md={"seq_positions": positions.tolist(), "seq_table_rows": len(positions)}
+        )
+        yield from bps.stage_all(*all_devices)
+        yield from bps.prepare(rot_motor, fly_info, group="seq_setup")
+        yield from bps.prepare(panda, trigger_info, group="seq_setup")
+        for det in detectors:
+            yield from bps.prepare(det, detector_trigger_info, group="seq_setup")
+        yield from bps.wait(group="seq_setup")
+
+        yield from bps.kickoff_all(*all_detectors, wait=True)
+        yield from bps.mv(seq.enable, "ONE")
+        yield from bps.kickoff(rot_motor, wait=True)
+
+        yield from collect_while_completing_flyers(
+            all_devices, all_detectors, stream_name="seq_stream"
+        )
+
+        yield from bps.unstage_all(*all_devices)
+        yield from bps.close_run()
+
+    def restore_triggers():
+        yield from bps.mv(seq.enable, "ZERO")
+        for pcomp, enable in pcomp_enables.items():
+            yield from bps.mv(pcomp.enable, enable)
+
+    yield from bpp.finalize_wrapper(scan(), restore_triggers())
+
+
+startup_profiler.stop_file(__file__)
@@ -1,17 +1,18 @@
-print(f"Loading file {__file__!r} ...")
+startup_profiler.start_file(__file__)
 
-import datetime
+import bluesky.preprocessors as bpp
+from ophyd_async.core import DetectorTrigger, TriggerInfo
+from ophyd_async.fastcs.panda import PandaPcompDirection
 
-# Number of encoder counts for an entire revolution
-COUNTS_PER_REVOLUTION = 8000
-DEG_PER_REVOLUTION = 360
-COUNTS_PER_DEG = COUNTS_PER_REVOLUTION / DEG_PER_REVOLUTION
 
-
-from ophyd_async.core import TriggerInfo
-from ophyd_async.epics.motor import FlyMotorInfo
+def pcomp_direction(trajectory):
+    """The PCOMP direction in which ``trajectory``'s trigger positions are passed."""
+    if trajectory.direction > 0:
+        return PandaPcompDirection.POSITIVE
+    return PandaPcompDirection.NEGATIVE
 
 
+@plan_timer.timed
 def tomo_demo_async(
     detectors,
     panda,
@@ -19,68 +20,50 @@ def tomo_demo_async(
     scan_time=9,
     start_deg=0,
     exposure_time=None,
+    live_reader=None,
 ):
 
     pcomp = panda.pcomp[1]
 
-    step_width_counts = COUNTS_PER_REVOLUTION / (2 * (num_images - 1))
-    if int(step_width_counts) != round(step_width_counts, 5):
-        raise ValueError(
-            "The number of encoder counts per pulse is not an integer value!"
-        )
-
-    step_time = scan_time / num_images
-    if exposure_time is not None:
-        if exposure_time > step_time:
-            raise RuntimeError(
-                f"Your configured exposure time is longer than the step size {step_time}"
-            )
-    else:
-        exposure_time = step_time / 3
+    calibrations = yield from read_panda_calibration(panda)
+    encoder = calibrations["INENC1.VAL"]
+    max_velocity = yield from bps.rd(rot_motor.max_velocity)
+    acceleration_time = yield from bps.rd(rot_motor.acceleration_time)
+    trajectory = plan_tomo_trajectory(
+        num_images,
+        scan_time,
+        start_deg=start_deg,
+        exposure_time=exposure_time,
+        max_velocity=max_velocity,
+        acceleration_time=acceleration_time,
+        counts_per_deg=encoder.counts_per_unit,
+    )
+    exposure_time = trajectory.exposure_time
 
     all_detectors = [*detectors, panda]
     all_devices = [*all_detectors, rot_motor]
 
     det_trigger_info = TriggerInfo(
-        number_of_triggers=num_images,
+        number_of_events=num_images,
         livetime=exposure_time,
         deadtime=0.001,
         trigger=DetectorTrigger.EDGE_TRIGGER,
     )
 
     panda_trigger_info = TriggerInfo(
-        number_of_triggers=num_images,
+        number_of_events=num_images,
         livetime=exposure_time,
         deadtime=0.001,
         trigger=DetectorTrigger.CONSTANT_GATE,
     )
 
-    rot_motor_fly_info = FlyMotorInfo(
-        start_position=start_deg - 5,
-        end_position=start_deg + DEG_PER_REVOLUTION / 2 + 5,
-        time_for_move=scan_time,
-    )
+    rot_motor_fly_info = trajectory.fly_info
 
-    start_encoder = start_deg * COUNTS_PER_DEG
+    print(f"Exposing camera for {trajectory.gate_counts} counts")
 
-    width_in_counts = (180 / scan_time) * COUNTS_PER_DEG * exposure_time
-    if width_in_counts > step_width_counts:
-        raise RuntimeError(
-            f"Your specified exposure time of {exposure_time}s is too long! Calculated width: {width_in_counts}, Step size: {step_width_counts}"
-        )
-    print(f"Exposing camera for {width_in_counts} counts")
-
-    # Set up the pcomp block
-    yield from bps.mv(pcomp.start, int(start_encoder))
-
-    # Uncomment if using gate trigger mode on camera
-    # yield from bps.mv(
-    #    panda3_pcomp_1.width, width_in_counts
-    # )  # Width in encoder counts that the pulse will be high
-    yield from bps.mv(pcomp.step, step_width_counts)
-    yield from bps.mv(pcomp.pulses, num_images)
-
-    yield from bps.open_run()
+    yield from bps.open_run(
+        md={"panda_calibration": calibration_metadata(calibrations)}
+    )
 
     # The setup below is happening in the VimbaController's arm method.
     # # Setup camera in trigger mode
@@ -89,25 +72,44 @@ def tomo_demo_async(
     # yield from bps.mv(manta_async.overlap, "Off")
     # yield from bps.mv(manta_async.expose_out_mode, "TriggerWidth")  # "Timed" or "TriggerWidth"
 
-    # Stage All!
-    yield from bps.stage_all(*all_devices)
-
-    for det in detectors:
-        yield from bps.prepare(det, det_trigger_info, group="prepare_all", wait=False)
-
-    yield from bps.prepare(panda, panda_trigger_info, group="prepare_all", wait=False)
-
-    yield from bps.prepare(
-        rot_motor, rot_motor_fly_info, group="prepare_all", wait=False
+    # The PCOMP setup runs alongside staging and preparing (which moves the motor
+    # to its run-up position); each device is prepared as soon as it is staged.
+    setup = SetupGraph()
+    # The direction may have been left reversed by a bidirectional
+    # tomo_multi_sweep_async.
+    setup.add("pcomp_dir", bps.abs_set, pcomp.dir, pcomp_direction(trajectory))
+    setup.add(
+        "pcomp_start", bps.abs_set, pcomp.start, int(trajectory.positions_counts[0])
     )
+    setup.add("pcomp_step", bps.abs_set, pcomp.step, trajectory.step_counts)
+    setup.add("pcomp_pulses", bps.abs_set, pcomp.pulses, trajectory.num_images)
+    # Uncomment if using gate trigger mode on camera
+    # setup.add(
+    #     "pcomp_width",
+    #     bps.abs_set,
+    #     pcomp.width,  # Width in encoder counts that the pulse will be high
+    #     trajectory.gate_counts,
+    # )
+    prepares = [
+        *((det, det_trigger_info) for det in detectors),
+        (panda, panda_trigger_info),
+        (rot_motor, rot_motor_fly_info),
+    ]
+    for device, info in prepares:
+        stage = setup.add(f"stage_{device.name}", bps.stage, device, wait=False)
+        setup.add(f"prepare_{device.name}", bps.prepare, device, info, after=[stage])
+    yield from setup.run()
+
+    def fly():
+        if live_reader is not None:
+            yield from start_panda_live_reader(panda, live_reader, calibrations)
+        yield from bps.kickoff_all(*all_devices, wait=True)
+
+        yield from collect_while_completing_flyers(
+            all_devices, all_detectors, stream_name="tomo_stream"
+        )
 
-    yield from bps.wait(group="prepare_all")
-    yield from bps.kickoff_all(*all_devices, wait=True)
-
-    yield from bps.declare_stream(*all_detectors, name="tomo_stream")
-    yield from bps.collect_while_completing(
-        all_devices, all_detectors, flush_period=0.25, stream_name="tomo_stream"
-    )
+    yield from bpp.finalize_wrapper(fly(), stop_panda_live_reader(live_reader))
 
     yield from bps.unstage_all(*all_devices)
 
@@ -123,6 +125,129 @@ def tomo_demo_async(
     yield from bps.mv(rot_motor.velocity, 180 / 2)
 
 
+@plan_timer.timed
+def tomo_multi_sweep_async(
+    detectors,
+    panda,
+    num_sweeps,
+    num_images=21,
+    scan_time=9,
+    start_deg=0,
+    exposure_time=None,
+    bidirectional=True,
+    single_file=True,
+    live_reader=None,
+):
+    """Run ``num_sweeps`` rotation fly scans back to back in one run.
+
+    The devices are staged once and every sweep's trajectory is planned before the
+    run starts. Between two sweeps the motor's turnaround to the next run-up
+    position, the PCOMP setup and (unless ``single_file``) the detectors' re-arming
+    are issued together, so the dead time is the slowest of them instead of their
+    sum. With ``single_file`` the detectors and PandA are prepared once for the
+    frames of all sweeps and append every sweep to the same file; otherwise they
+    are prepared again, and open a new file, for each sweep.
+    """
+    pcomp = panda.pcomp[1]
+
+    calibrations = yield from read_panda_calibration(panda)
+    encoder = calibrations["INENC1.VAL"]
+    max_velocity = yield from bps.rd(rot_motor.max_velocity)
+    acceleration_time = yield from bps.rd(rot_motor.acceleration_time)
+    sweeps = plan_tomo_sweeps(
+        num_sweeps,
+        num_images,
+        scan_time,
+        start_deg=start_deg,
+        exposure_time=exposure_time,
+        max_velocity=max_velocity,
+        acceleration_time=acceleration_time,
+        counts_per_deg=encoder.counts_per_unit,
+        bidirectional=bidirectional,
+    )
+    exposure_time = sweeps[0].exposure_time
+
+    all_detectors = [*detectors, panda]
+    all_devices = [*all_detectors, rot_motor]
+
+    # A list of event counts makes each kickoff cover one sweep of a single file.
+    number_of_events = [num_images] * num_sweeps if single_file else num_images
+    det_trigger_info = TriggerInfo(
+        number_of_events=number_of_events,
+        livetime=exposure_time,
+        deadtime=0.001,
+        trigger=DetectorTrigger.EDGE_TRIGGER,
+    )
+    panda_trigger_info = TriggerInfo(
+        number_of_events=number_of_events,
+        livetime=exposure_time,
+        deadtime=0.001,
+        trigger=DetectorTrigger.CONSTANT_GATE,
+    )
+
+    def arm(sweep, prepare_detectors, group):
+        yield from bps.abs_set(pcomp.enable, "ZERO", group=group)
+        yield from bps.abs_set(pcomp.dir, pcomp_direction(sweep), group=group)
+        yield from bps.abs_set(pcomp.start, int(sweep.positions_counts[0]), group=group)
+        yield from bps.abs_set(pcomp.step, sweep.step_counts, group=group)
+        yield from bps.abs_set(pcomp.pulses, sweep.num_images, group=group)
+        yield from bps.prepare(rot_motor, sweep.fly_info, group=group)
+        if prepare_detectors:
+            for det in detectors:
+                yield from bps.prepare(det, det_trigger_info, group=group)
+            yield from bps.prepare(panda, panda_trigger_info, group=group)
+        yield from bps.wait(group=group)
+
+    def run_sweeps():
+        yield from bps.open_run(
+            md={
+                "num_sweeps": num_sweeps,
+                "sweep_directions": [sweep.direction for sweep in sweeps],
+                "single_file": single_file,
+                "panda_calibration": calibration_metadata(calibrations),
+            }
+        )
+        yield from bps.stage_all(*all_devices)
+        yield from arm(sweeps[0], prepare_detectors=True, group="arm_sweep")
+        yield from bps.declare_stream(*all_detectors, name="tomo_stream")
+
+        for i, sweep in enumerate(sweeps):
+            last = i == len(sweeps) - 1
+            if live_reader is not None and (i == 0 or not single_file):
+                yield from start_panda_live_reader(panda, live_reader, calibrations)
+            yield from bps.kickoff_all(*all_detectors, wait=True)
+            yield from bps.mv(pcomp.enable, "ONE")
+            yield from bps.kickoff(rot_motor, wait=True)
+            yield from collect_while_completing_flyers(
+                all_devices, all_detectors, stream_name="tomo_stream", declare=False
+            )
+            if live_reader is not None and (last or not single_file):
+                live_reader.stop()
+            if not last:
+                yield from arm(
+                    sweeps[i + 1], prepare_detectors=not single_file, group="arm_sweep"
+                )
+
+        yield from bps.unstage_all(*all_devices)
+        yield from bps.close_run()
+
+    # The sweeps toggle PCOMP's enable input and reverse its direction; put the
+    # layout's settings back after, also when a sweep fails.
+    pcomp_enable = yield from bps.rd(pcomp.enable)
+    pcomp_dir = yield from bps.rd(pcomp.dir)
+
+    def restore_pcomp():
+        yield from stop_panda_live_reader(live_reader)
+        yield from bps.mv(pcomp.dir, pcomp_dir)
+        yield from bps.mv(pcomp.enable, pcomp_enable)
+
+    yield from bpp.finalize_wrapper(run_sweeps(), restore_pcomp())
+
+    # Reset the velocity back to high.
+    yield from bps.mv(rot_motor.velocity, 180 / 2)
+
+
+@plan_timer.timed
 def xas_demo_async(
     panda,
     detector,
@@ -134,7 +259,10 @@ def xas_demo_async(
     #    scan_time=9,
     #    start_deg=0,
     #    exposure_time=None,
+    live_reader=None,
 ):
+    # Not ported to ophyd-async yet: the PandA has no CLOCK block in this layout,
+    # and panda_flyer, manta_flyer, StandardTriggerSetup and TomoFrameType are gone.
 
     start_deg = start_e
     end_deg = end_e
@@ -143,6 +271,9 @@ def xas_demo_async(
     panda_pcap1 = panda.pcap
     panda_clock1 = panda.clock[1]
 
+    calibrations = yield from read_panda_calibration(panda)
+    counts_per_deg = calibrations["INENC1.VAL"].counts_per_unit
+
     reset_time = 0.001  # [ms], 1 us difference is usually enough
 
     clock_period_ms = total_time * 1000 / npoints  # [ms]
@@ -155,11 +286,11 @@ def xas_demo_async(
     # WIDTH     -> end_cnt - start_cnt
 
     pre_start_deg = 5.0  # [deg], we are working in relative mode, zero is the position where pcomp was enabled
-    pre_start_cnt = pre_start_deg * COUNTS_PER_DEG
+    pre_start_cnt = pre_start_deg * counts_per_deg
 
     start_cnt = pre_start_cnt
     width_deg = end_deg - start_deg
-    width_cnt = width_deg * COUNTS_PER_DEG
+    width_cnt = width_deg * counts_per_deg
 
     print(f"{pre_start_cnt=}, {width_deg=}, {width_cnt=}")
 
@@ -237,7 +368,9 @@ def xas_demo_async(
     yield from bps.mv(panda_clock1.width, clock_width_ms)
     yield from bps.mv(panda_clock1.width_units, "ms")
     print("000: panda clock configured, ", datetime.datetime.now().strftime("%H:%M:%S"))
-    yield from bps.open_run()
+    yield from bps.open_run(
+        md={"panda_calibration": calibration_metadata(calibrations)}
+    )
     print("001: run open,", datetime.datetime.now().strftime("%H:%M:%S"))
     if detector:
         detector._writer._path_provider._filename_provider.set_frame_type(
@@ -273,48 +406,59 @@ def xas_demo_async(
         datetime.datetime.now().strftime("%H:%M:%S"),
     )
 
-    for device in all_devices:
-        yield from bps.kickoff(device)
-    print("007: kickoff complete, ", datetime.datetime.now().strftime("%H:%M:%S"))
-
-    # yield from bps.sleep(0.1)
-    yield from bps.mv(panda_pcomp1.enable, "ONE")
-    yield from bps.mv(
-        rot_motor, end_deg + pre_start_deg
-    )  # Aiming beyond the end point to maintain constant veolcity
-    print("006: motor mv start, ", datetime.datetime.now().strftime("%H:%M:%S"))
-
-    for flyer_or_panda in panda_devices:
-        yield from bps.complete(flyer_or_panda, wait=True, group="complete_panda")
-    print("008: panda complete, ", datetime.datetime.now().strftime("%H:%M:%S"))
-    if detector:
-        for flyer_or_det in detector_devices:
-            yield from bps.complete(flyer_or_det, wait=True, group="complete_detector")
-        print("009: detector complete, ", datetime.datetime.now().strftime("%H:%M:%S"))
-    # Manually incremenet the index as if a frame was taken
-    # detector.writer.index += 1
-    print("ACQUISITION COMPLETE", datetime.datetime.now().strftime("%H:%M:%S"))
-
-    # Wait for completion of the PandA HDF5 file saving.
-    done = False
-    while not done:
-        try:
-            yield from bps.wait(group="complete_panda", timeout=0.5)
-        except TimeoutError:
-            pass
-        else:
-            done = True
-
-        panda_stream_name = f"{panda.name}_stream"
-        yield from bps.declare_stream(panda, name=panda_stream_name)
+    def fly():
+        if live_reader is not None:
+            yield from start_panda_live_reader(panda, live_reader, calibrations)
+
+        for device in all_devices:
+            yield from bps.kickoff(device)
+        print("007: kickoff complete, ", datetime.datetime.now().strftime("%H:%M:%S"))
+
+        # yield from bps.sleep(0.1)
+        yield from bps.mv(panda_pcomp1.enable, "ONE")
+        yield from bps.mv(
+            rot_motor, end_deg + pre_start_deg
+        )  # Aiming beyond the end point to maintain constant veolcity
+        print("006: motor mv start, ", datetime.datetime.now().strftime("%H:%M:%S"))
+
+        for flyer_or_panda in panda_devices:
+            yield from bps.complete(flyer_or_panda, wait=True, group="complete_panda")
+        print("008: panda complete, ", datetime.datetime.now().strftime("%H:%M:%S"))
+        if detector:
+            for flyer_or_det in detector_devices:
+                yield from bps.complete(
+                    flyer_or_det, wait=True, group="complete_detector"
+                )
+            print(
+                "009: detector complete, ",
+                datetime.datetime.now().strftime("%H:%M:%S"),
+            )
+        # Manually incremenet the index as if a frame was taken
+        # detector.writer.index += 1
+        print("ACQUISITION COMPLETE", datetime.datetime.now().strftime("%H:%M:%S"))
+
+        # Wait for completion of the PandA HDF5 file saving.
+        done = False
+        while not done:
+            try:
+                yield from bps.wait(group="complete_panda", timeout=0.5)
+            except TimeoutError:
+                pass
+            else:
+                done = True
+
+            panda_stream_name = f"{panda.name}_stream"
+            yield from bps.declare_stream(panda, name=panda_stream_name)
+
+            yield from bps.collect(
+                panda,
+                # stream=True,
+                # return_payload=False,
+                name=panda_stream_name,
+            )
+        print("PANDA FILE SAVING COMPLETE")
 
-        yield from bps.collect(
-            panda,
-            # stream=True,
-            # return_payload=False,
-            name=panda_stream_name,
-        )
-    print("PANDA FILE SAVING COMPLETE")
+    yield from bpp.finalize_wrapper(fly(), stop_panda_live_reader(live_reader))
     yield from bps.unstage_all(*panda_devices)
     yield from bps.mv(panda_pcomp1.enable, "ZERO")
     print("PANDA UNSTAGING COMPLETE")
@@ -354,4 +498,4 @@ def xas_demo_async(
     yield from bps.mv(rot_motor.velocity, 180 / 2)
 
 
-# file_loading_timer.stop_timer(__file__)
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,145 @@
+startup_profiler.start_file(__file__)
+
+import asyncio
+import gzip
+import inspect
+import json
+import typing
+from enum import Enum
+
+import numpy as np
+from ophyd_async.core import SignalRW
+from pydantic import BaseModel
+
+# Writable signals that trigger an action (acquisition, capture, a motor move)
+# rather than hold a setting, so they are neither saved nor restored.
+SNAPSHOT_EXCLUDE = (
+    "*acquire",
+    "*capture",
+    "*arm",
+    "*user_setpoint",
+    "*flush_now",
+)
+
+
+def _snapshot_devices(devices):
+    return devices or (panda1, manta1, manta2, rot_motor)
+
+
+def _snapshot_signals(device, exclude=SNAPSHOT_EXCLUDE):
+    return dict(iter_signals(device, exclude=exclude, signal_class=SignalRW))
+
+
+def _to_jsonable(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, BaseModel):
+        return {key: _to_jsonable(column) for key, column in value.model_dump().items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(item) for item in value]
+    return value
+
+
+def _from_jsonable(signal, value):
+    datatype = signal._connector.backend.datatype
+    if inspect.isclass(datatype) and issubclass(datatype, BaseModel):
+        return datatype(**value)
+    if inspect.isclass(datatype) and issubclass(datatype, Enum):
+        return datatype(value)
+    if typing.get_origin(datatype) is np.ndarray:
+        return np.asarray(value)
+    return value
+
+
+async def read_settings(devices, exclude=SNAPSHOT_EXCLUDE):
+    """Read every SignalRW of ``devices`` concurrently.
+
+    Returns ``{device_name: {dotted_path: value}}`` with JSON-compatible values.
+    """
+    signals = [
+        (device.name, path, signal)
+        for device in devices
+        for path, signal in _snapshot_signals(device, exclude).items()
+    ]
+    values = await asyncio.gather(*(signal.get_value() for _, _, signal in signals))
+
+    settings = {device.name: {} for device in devices}
+    for (device_name, path, _), value in zip(signals, values):
+        settings[device_name][path] = _to_jsonable(value)
+    return settings
+
+
+def write_snapshot_file(path, settings):
+    """Write settings compactly as JSON, gzip-compressed if ``path`` ends in .gz."""
+    content = json.dumps(
+        {"created": now(), "devices": settings}, separators=(",", ":")
+    ).encode()
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wb") as f:
+        f.write(content)
+
+
+def read_snapshot_file(path):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return json.loads(f.read())["devices"]
+
+
+def save_snapshot(path, *devices, exclude=SNAPSHOT_EXCLUDE):
+    """Save the settings of ``devices`` (default: PandA, Mantas, rotation motor).
+
+    All SignalRWs are read in a single concurrent pass.
+    """
+    devices = _snapshot_devices(devices)
+    settings = yield from call_async(read_settings, devices, exclude)
+    write_snapshot_file(path, settings)
+    return settings
+
+
+def diff_snapshot(path, *devices, exclude=SNAPSHOT_EXCLUDE):
+    """Compare a saved snapshot with the live values.
+
+    Returns ``{device_name: {dotted_path: (saved, live)}}`` for differing signals.
+    """
+    devices = _snapshot_devices(devices)
+    saved = read_snapshot_file(path)
+    live = yield from call_async(read_settings, devices, exclude)
+
+    diff = {}
+    for device in devices:
+        saved_values = saved.get(device.name, {})
+        for signal_path, live_value in live[device.name].items():
+            if signal_path in saved_values and saved_values[signal_path] != live_value:
+                diff.setdefault(device.name, {})[signal_path] = (
+                    saved_values[signal_path],
+                    live_value,
+                )
+    return diff
+
+
+def restore_snapshot(path, *devices, exclude=SNAPSHOT_EXCLUDE):
+    """Write back the saved settings that differ from the live values.
+
+    All changed signals are set in one group and waited on together, so restoring
+    costs about one round trip regardless of how many signals changed.
+    """
+    devices = _snapshot_devices(devices)
+    diff = yield from diff_snapshot(path, *devices, exclude=exclude)
+
+    args = []
+    for device in devices:
+        signals = _snapshot_signals(device, exclude)
+        for signal_path, (saved, _) in diff.get(device.name, {}).items():
+            signal = signals[signal_path]
+            args.extend([signal, _from_jsonable(signal, saved)])
+    if args:
+        yield from bps.mv(*args)
+    print(f"Restored {len(args) // 2} signals from {path}.")
+    return diff
+
+
+startup_profiler.stop_file(__file__)
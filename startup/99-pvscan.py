@@ -1,8 +1,10 @@
-print(f"Loading file {__file__!r} ...")
+startup_profiler.start_file(__file__)
 
+import fnmatch
+import hashlib
 import json
 from enum import Enum
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
 
 from ophyd_async.core import Device, Signal
 
@@ -21,47 +23,186 @@ def enum_to_dict(enum_class):
     }
 
 
+def _matches_any(path: str, patterns: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+
+def iter_device_tree(
+    device: Device,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    max_depth: Optional[int] = None,
+    path_prefix: str = "",
+) -> Iterator[Tuple[str, Device]]:
+    """Lazily yield ``(dotted_path, child)`` for the descendants of a device.
+
+    The tree is walked depth first, in ``children()`` order, without recursion and
+    without building intermediate collections, so a caller that stops iterating
+    stops the walk.
+
+    Parameters
+    ----------
+    device : Device
+        Ophyd device to walk.
+
+    include : list of str, optional
+        Glob patterns (``fnmatch`` syntax, e.g. ``"pcomp.*"``); only children whose
+        dotted path matches one of them are yielded. Non-matching children are still
+        descended into.
+
+    exclude : list of str, optional
+        Glob patterns of dotted paths to skip, together with everything below them.
+
+    max_depth : int, optional
+        Number of levels to descend, e.g. 1 yields only the direct children. Matches
+        the ``depth`` of the queueserver's user group permissions.
+
+    path_prefix : str
+        Prefix prepended to every yielded path.
+    """
+
+    stack = [(path_prefix, iter(device.children()))]
+    while stack:
+        prefix, children = stack[-1]
+        try:
+            attr_name, attr = next(children)
+        except StopIteration:
+            stack.pop()
+            continue
+
+        dot_path = f"{prefix}{attr_name}"
+        if exclude and _matches_any(dot_path, exclude):
+            continue
+        if not include or _matches_any(dot_path, include):
+            yield dot_path, attr
+        if max_depth is None or len(stack) < max_depth:
+            stack.append((dot_path + ".", iter(attr.children())))
+
+
+def iter_signals(
+    device: Device,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    max_depth: Optional[int] = None,
+    signal_class: type = Signal,
+    path_prefix: str = "",
+) -> Iterator[Tuple[str, Signal[Any]]]:
+    """Lazily yield ``(dotted_path, signal)`` for the signals of a device.
+
+    Takes the same filters as :func:`iter_device_tree`; ``signal_class`` narrows
+    the result further, e.g. to ``SignalRW``.
+    """
+
+    for dot_path, attr in iter_device_tree(
+        device, include, exclude, max_depth, path_prefix
+    ):
+        if isinstance(attr, signal_class):
+            yield dot_path, attr
+
+
 def walk_signals(
     device: Device, path_prefix: Optional[str] = ""
 ) -> Dict[str, Signal[Any]]:
-    """Retrieve all SignalRWs from a device.
+    """Retrieve all Signals from a device.
 
     Stores retrieved signals with their dotted attribute paths in a dictionary. Used as
-    part of saving and loading a device.
+    part of saving and loading a device. Use :func:`iter_signals` to visit only part
+    of the device tree.
 
     Parameters
     ----------
     device : Device
-        Ophyd device to retrieve read-write signals from.
+        Ophyd device to retrieve signals from.
 
     path_prefix : str
-        For internal use, leave blank when calling the method.
+        Prefix prepended to every attribute path, leave blank when calling the method.
 
     Returns
     -------
-    SignalRWs : dict
-        A dictionary matching the string attribute path of a SignalRW with the
+    Signals : dict
+        A dictionary matching the string attribute path of a Signal with the
         signal itself.
 
-        See Also
+    See Also
     --------
     :func:`ophyd_async.core.get_signal_values`
     :func:`ophyd_async.core.save_to_yaml`
 
     """
 
-    if not path_prefix:
-        path_prefix = ""
+    return dict(iter_signals(device, path_prefix=path_prefix or ""))
+
 
-    signals: Dict[str, Signal[Any]] = {}
-    for attr_name, attr in device.children():
-        dot_path = f"{path_prefix}{attr_name}"
-        # if type(attr) is Signal:
-        if isinstance(attr, Signal):
-            signals[dot_path] = attr
-        attr_signals = walk_signals(attr, path_prefix=dot_path + ".")
-        signals.update(attr_signals)
-    return signals
+def signal_type(signal: Signal[Any]):
+    """Name of a signal's datatype, or the description of its enum."""
+    datatype = signal._connector.backend.datatype
+    if issubclass(datatype, Enum):
+        return enum_to_dict(datatype)
+    return datatype.__name__
+
+
+class SignalIndex:
+    """Inventory of the signals of every device, with their PV sources and types.
+
+    Each device is walked once, when it is added (``device_registry`` adds devices
+    as they connect), and the result is kept both per device and per PV source.
+    Adding a device that is already indexed is a no-op unless ``replace=True``.
+    """
+
+    def __init__(self):
+        self._by_device: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._by_source: Dict[str, Any] = {}
+        self._written: Dict[str, str] = {}
+
+    def add_device(self, device: Device, replace: bool = False):
+        if device.name in self._by_device and not replace:
+            return
+        entries = {
+            signal.name: {"pv": signal.source, "type": signal_type(signal)}
+            for _, signal in iter_signals(device)
+        }
+        self._by_device[device.name] = entries
+        for entry in entries.values():
+            self._by_source[entry["pv"]] = entry["type"]
+
+    def add_devices(self, objects):
+        """Index the devices among ``objects`` that are not indexed yet."""
+        for obj in objects:
+            if isinstance(obj, Device):
+                self.add_device(obj)
+
+    @property
+    def by_device(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        return self._by_device
+
+    @property
+    def by_source(self) -> Dict[str, Any]:
+        return self._by_source
+
+    def write(self, path: str = "pv_types.json") -> bool:
+        """Write the PV types to ``path`` unless the file already holds them.
+
+        Returns True if the file was (re)written.
+        """
+        content = json.dumps(self._by_source, sort_keys=True).encode()
+        digest = hashlib.sha256(content).hexdigest()
+        if self._written.get(path) == digest:
+            return False
+
+        try:
+            with open(path, "rb") as f:
+                unchanged = hashlib.sha256(f.read()).hexdigest() == digest
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            with open(path, "wb") as f:
+                f.write(content)
+        self._written[path] = digest
+        return not unchanged
+
+
+signal_index = SignalIndex()
+device_registry.add_connect_callback(signal_index.add_device)
 
 
 def get_signal_pv_types():
@@ -69,23 +210,8 @@ def get_signal_pv_types():
     This is a dictionary that maps the Devices and Signals in the profile to their pvs and types.
     """
 
-    devices = [g for g in globals().values() if isinstance(g, Device)]
-    pvs = {
-        device.name: {
-            signal.name: {
-                "pv": signal.source,
-                "type": (
-                    enum_to_dict(signal._connector.backend.datatype)
-                    if issubclass(signal._connector.backend.datatype, Enum)
-                    else signal._connector.backend.datatype.__name__
-                ),
-            }
-            for signal in walk_signals(device).values()
-            if isinstance(signal, Signal)
-        }
-        for device in devices
-    }
-    return pvs
+    signal_index.add_devices(globals().values())
+    return signal_index.by_device
 
 
 def get_pv_types():
@@ -93,16 +219,9 @@ def get_pv_types():
     This is a dictionary that maps all of the PVs in the profile to their types.
     """
 
-    devices = [g for g in globals().values() if isinstance(g, Device)]
-    pv_types = {
-        signal.source: (
-            enum_to_dict(signal._connector.backend.datatype)
-            if issubclass(signal._connector.backend.datatype, Enum)
-            else signal._connector.backend.datatype.__name__
-        )
-        for device in devices
-        for signal in walk_signals(device).values()
-    }
-    with open("pv_types.json", "w") as f:
-        json.dump(pv_types, f)
-    return pv_types
+    signal_index.add_devices(globals().values())
+    signal_index.write("pv_types.json")
+    return signal_index.by_source
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,251 @@
+startup_profiler.start_file(__file__)
+
+import re
+import threading
+
+import yaml
+from bluesky.protocols import Flyable, Movable, Readable
+
+USER_GROUP_PERMISSIONS_FILE = Path(__file__).parent / "user_group_permissions.yaml"
+
+# The device types a device pattern may be restricted to, as in the queueserver.
+_DEVICE_TYPE_CONDITIONS = {
+    "": lambda kind: True,
+    "__READABLE__": lambda kind: kind["is_readable"],
+    "__DETECTOR__": lambda kind: kind["is_readable"] and not kind["is_movable"],
+    "__MOTOR__": lambda kind: kind["is_readable"] and kind["is_movable"],
+    "__FLYABLE__": lambda kind: kind["is_flyable"],
+}
+
+
+def _strip_marker(component):
+    return component[1:] if component[:1] in ("+", "-", "?") else component
+
+
+def _device_kind(device):
+    return {
+        "is_readable": isinstance(device, Readable),
+        "is_movable": isinstance(device, Movable),
+        "is_flyable": isinstance(device, Flyable),
+    }
+
+
+class _NamePatterns:
+    """An allowed or forbidden list of plan or function names, compiled once.
+
+    Explicit names go into a set and the regular expressions into a single
+    alternation, so a name is checked with one lookup and one search.
+    """
+
+    def __init__(self, patterns, none_matches_all):
+        patterns = patterns or []
+        self.match_all = bool(patterns) and patterns[0] is None and none_matches_all
+        self.names = set()
+        expressions = []
+        for pattern in patterns:
+            if pattern is None:
+                continue
+            pattern = pattern.replace(" ", "")
+            if ":" in pattern:
+                expressions.append(_strip_marker(pattern.split(":")[-1]))
+            else:
+                self.names.add(pattern)
+        self.regex = (
+            re.compile("|".join(f"(?:{e})" for e in expressions))
+            if expressions
+            else None
+        )
+
+    def __call__(self, name):
+        return (
+            self.match_all
+            or name in self.names
+            or (self.regex is not None and self.regex.search(name) is not None)
+        )
+
+
+class _DevicePattern:
+    """One device pattern of the queueserver's syntax, e.g. ``:^det:?.*:depth=5``.
+
+    Each ``:`` separated component is matched against one level of the dotted
+    device path; a ``?`` component is matched against the rest of the path, at
+    most ``depth`` levels of it. A device that the components stop at is matched
+    unless its component is marked ``-``.
+    """
+
+    def __init__(self, pattern):
+        pattern = pattern.replace(" ", "")
+        self.name = None
+        if ":" not in pattern:
+            self.name = pattern
+            return
+        device_type, *components = pattern.split(":")
+        depth = None
+        if components[-1].startswith("depth="):
+            depth = int(components.pop()[len("depth=") :])
+        self.condition = _DEVICE_TYPE_CONDITIONS[device_type]
+        self.components = []
+        self.rest = None
+        for n, component in enumerate(components):
+            if component.startswith("?"):
+                self.rest = (re.compile(component[1:]), depth)
+                break
+            include = not component.startswith("-") or n == len(components) - 1
+            self.components.append((re.compile(_strip_marker(component)), include))
+
+    def __call__(self, parts, kind):
+        if self.name is not None:
+            return ".".join(parts) == self.name
+        if not self.condition(kind):
+            return False
+        for part, (regex, _) in zip(parts, self.components):
+            if regex.search(part) is None:
+                return False
+        if len(parts) <= len(self.components):
+            return self.components[len(parts) - 1][1]
+        if self.rest is None:
+            return False
+        regex, depth = self.rest
+        rest = parts[len(self.components) :]
+        if depth is not None and len(rest) > depth:
+            return False
+        return regex.search(".".join(rest)) is not None
+
+
+class _DevicePatterns:
+    def __init__(self, patterns, none_matches_all):
+        patterns = patterns or []
+        self.match_all = bool(patterns) and patterns[0] is None and none_matches_all
+        self.patterns = [_DevicePattern(p) for p in patterns if p is not None]
+
+    def __call__(self, parts, kind):
+        return self.match_all or any(pattern(parts, kind) for pattern in self.patterns)
+
+
+class _GroupPermissions:
+    def __init__(self, rules):
+        self.plans = (
+            _NamePatterns(rules.get("allowed_plans"), True),
+            _NamePatterns(rules.get("forbidden_plans"), False),
+        )
+        self.functions = (
+            _NamePatterns(rules.get("allowed_functions"), True),
+            _NamePatterns(rules.get("forbidden_functions"), False),
+        )
+        self.devices = (
+            _DevicePatterns(rules.get("allowed_devices"), True),
+            _DevicePatterns(rules.get("forbidden_devices"), False),
+        )
+
+    @staticmethod
+    def allows(lists, *args):
+        allowed, forbidden = lists
+        return allowed(*args) and not forbidden(*args)
+
+
+class PermissionMatcher:
+    """The user group permissions, compiled once and memoized per group.
+
+    Follows the queueserver's rules: a name is allowed for a group if the
+    ``root`` group and the group itself both allow it, i.e. it matches one of
+    their allowed patterns (or the list starts with ``null``) and none of their
+    forbidden ones. Every decision is remembered per name, and the allowed device
+    paths of each group that was asked for are kept as a set, which ``add_device``
+    extends with the subdevices of a new device instead of rebuilding it, only
+    forgetting the decisions about the paths it adds.
+
+    Devices are known once they are passed to ``add_device``; nothing adds them at
+    startup, so only the checks that need the device trees pay for walking them.
+
+    The RE Manager applies the same file with its own code when it opens the
+    environment; this is for the checks made in the profile.
+    """
+
+    def __init__(self, user_group_permissions, max_depth=5):
+        self.max_depth = max_depth
+        self._groups = {
+            name: _GroupPermissions(rules or {})
+            for name, rules in user_group_permissions["user_groups"].items()
+        }
+        self._root = self._groups.get("root")
+        self._devices = {}
+        self._decisions = {}
+        self._allowed_devices = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path=USER_GROUP_PERMISSIONS_FILE, **kwargs):
+        with open(path) as f:
+            return cls(yaml.safe_load(f), **kwargs)
+
+    @property
+    def groups(self):
+        return list(self._groups)
+
+    def is_plan_allowed(self, group, name):
+        return self._decide(group, "plans", name)
+
+    def is_function_allowed(self, group, name):
+        return self._decide(group, "functions", name)
+
+    def is_device_allowed(self, group, path):
+        """Whether the device or subdevice at dotted ``path`` is allowed."""
+        return self._decide(group, "devices", path)
+
+    def allowed_plans(self, group, names):
+        return [name for name in names if self.is_plan_allowed(group, name)]
+
+    def allowed_devices(self, group):
+        """Dotted paths of the added devices and subdevices ``group`` may use."""
+        with self._lock:
+            allowed = self._allowed_devices.get(group)
+            if allowed is None:
+                allowed = self._allowed_devices[group] = {
+                    path for path in self._devices if self._allows(group, path)
+                }
+            return frozenset(allowed)
+
+    def add_device(self, device):
+        """Add ``device`` and its subdevices down to ``max_depth`` levels."""
+        entries = [(device.name, device)]
+        entries += [
+            (f"{device.name}.{path}", child)
+            for path, child in iter_device_tree(device, max_depth=self.max_depth - 1)
+        ]
+        with self._lock:
+            for path, obj in entries:
+                self._devices[path] = _device_kind(obj)
+                self._decisions.pop(("devices", path), None)
+            for group, allowed in self._allowed_devices.items():
+                allowed.update(path for path, _ in entries if self._allows(group, path))
+
+    def _decide(self, group, what, name):
+        with self._lock:
+            return self._allows(group, name, what)
+
+    def _allows(self, group, name, what="devices"):
+        decisions = self._decisions.setdefault((what, name), {})
+        decision = decisions.get(group)
+        if decision is None:
+            if group not in self._groups:
+                raise KeyError(f"No permissions are defined for user group {group!r}")
+            if what == "devices":
+                args = (
+                    tuple(name.split(".")),
+                    self._devices.get(name, _device_kind(None)),
+                )
+            else:
+                args = (name,)
+            decision = all(
+                permissions.allows(getattr(permissions, what), *args)
+                for permissions in (self._root, self._groups[group])
+                if permissions is not None
+            )
+            decisions[group] = decision
+        return decision
+
+
+user_permissions = PermissionMatcher.from_file()
+
+
+startup_profiler.stop_file(__file__)
@@ -0,0 +1,3 @@
+# The last startup file: it sorts after every numbered one, so the report covers
+# the whole profile.
+startup_profiler.finish()